@@ -0,0 +1,252 @@
+"""
+Buffered recording of token usage.
+
+A `UsageRecorder` given to a `TokenGenerator` records every validation
+in a bounded in-process buffer. The request thread only appends a
+compact record, with its scope converted to plain data, to the buffer.
+A background thread periodically writes the buffered records in batches
+to a usage sink.
+
+If the buffer is full, new records are dropped and counted, so
+recording never blocks or slows down validation.
+"""
+
+import atexit, hashlib, json, logging, numbers, os, threading, time
+from collections import deque, namedtuple
+from datetime import datetime
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+from django.utils import timezone
+from django.utils.encoding import force_bytes, force_text
+
+from access_tokens.models import TokenUsage
+from access_tokens.scope import _PermissionIndex, string_types
+
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+
+TOKEN_DIGEST_LENGTH = 32
+
+
+UsageRecord = namedtuple("UsageRecord", ("token_digest", "scope", "granted", "timestamp",))
+
+UsageRecorderInfo = namedtuple("UsageRecorderInfo", ("recorded", "dropped", "failed", "pending", "buffer_size",))
+
+
+def get_token_digest(token):
+    """
+    Returns a digest identifying the given token, without revealing it.
+    """
+    return hashlib.sha256(force_bytes(token)).hexdigest()[:TOKEN_DIGEST_LENGTH]
+
+
+def _get_plain_scope(scope):
+    """
+    Returns the given scope, or part of a scope, as nested lists of strings
+    and numbers.
+
+    Compiled permission grants and sets become sorted lists. Other values,
+    such as date pks, become text.
+    """
+    if scope is None or isinstance(scope, string_types + (numbers.Number,)):
+        return scope
+    if isinstance(scope, (_PermissionIndex, set, frozenset)):
+        return sorted(_get_plain_scope(item) for item in scope)
+    if isinstance(scope, (list, tuple)):
+        return [
+            _get_plain_scope(item)
+            for item
+            in scope
+        ]
+    return force_text(scope)
+
+
+def _serialize_scope(scope):
+    """
+    Returns the given scope as JSON.
+    """
+    return json.dumps(_get_plain_scope(scope), separators=(",", ":"))
+
+
+# Usage sinks.
+
+
+class UsageSink(object):
+
+    """
+    Writes batches of usage records.
+
+    Subclasses must implement `write`.
+    """
+
+    def write(self, records):
+        """
+        Writes the given list of UsageRecords.
+        """
+        raise NotImplementedError
+
+
+class ModelUsageSink(UsageSink):
+
+    """
+    Writes usage records to the `TokenUsage` model, using one bulk insert
+    per batch.
+    """
+
+    def __init__(self, using=DEFAULT_DB_ALIAS):
+        """Initializes the ModelUsageSink."""
+        self._using = using
+
+    def _get_datetime(self, timestamp):
+        if settings.USE_TZ:
+            return datetime.utcfromtimestamp(timestamp).replace(tzinfo=timezone.utc)
+        return datetime.fromtimestamp(timestamp)
+
+    def write(self, records):
+        """
+        Writes the given list of UsageRecords.
+        """
+        TokenUsage.objects.using(self._using).bulk_create([
+            TokenUsage(
+                token_digest = record.token_digest,
+                scope = _serialize_scope(record.scope),
+                granted = record.granted,
+                timestamp = self._get_datetime(record.timestamp),
+            )
+            for record
+            in records
+        ])
+
+
+class FileUsageSink(UsageSink):
+
+    """
+    Appends usage records to a local file, as one JSON object per line.
+    """
+
+    def __init__(self, path):
+        """Initializes the FileUsageSink."""
+        self._path = path
+        self._lock = threading.Lock()
+
+    def write(self, records):
+        """
+        Writes the given list of UsageRecords.
+        """
+        data = "".join(
+            json.dumps(record._replace(scope=_get_plain_scope(record.scope))._asdict(), separators=(",", ":")) + "\n"
+            for record
+            in records
+        )
+        with self._lock:
+            with open(self._path, "a") as usage_file:
+                usage_file.write(data)
+
+
+# Usage recording.
+
+
+class UsageRecorder(object):
+
+    """
+    Buffers usage records in memory, and writes them to the given sink in
+    batches of up to `batch_size` records.
+
+    At most `buffer_size` records are buffered. Further records are
+    dropped and counted until the buffer has been flushed. A daemon thread
+    flushes the buffer every `flush_interval` seconds. It is started when
+    the first record is made. If `flush_interval` is None, no thread is
+    started, and the buffer must be flushed by calling `flush`.
+    """
+
+    def __init__(self, sink, buffer_size=10000, batch_size=500, flush_interval=1.0):
+        """Initializes the UsageRecorder."""
+        self._sink = sink
+        self._buffer_size = buffer_size
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        self._buffer = deque()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._recorded_count = 0
+        self._dropped_count = 0
+        self._failed_count = 0
+        self._flusher = None
+        self._flusher_pid = None
+        self._flusher_lock = threading.Lock()
+        atexit.register(self.flush)
+
+    def _ensure_flusher(self):
+        """
+        Starts the flusher thread, if it is not already running in this
+        process.
+        """
+        if self._flush_interval is None or self._flusher_pid == os.getpid():
+            return
+        with self._flusher_lock:
+            # The flusher thread does not survive a fork, so is started again in each child process.
+            if self._flusher_pid != os.getpid():
+                self._flusher = threading.Thread(target=self._run_flusher, name="access_tokens.audit")
+                self._flusher.daemon = True
+                self._flusher.start()
+                self._flusher_pid = os.getpid()
+
+    def _run_flusher(self):
+        while True:
+            time.sleep(self._flush_interval)
+            self.flush()
+
+    def record(self, token, scope, granted):
+        """
+        Records the validation of the given token against the given scope.
+
+        The scope is recorded as plain data. If it cannot be converted, only
+        this record is dropped, and counted as failed.
+        """
+        try:
+            record = UsageRecord(get_token_digest(token), _get_plain_scope(scope), granted, time.time())
+        except Exception:
+            logger.exception("Could not record token usage")
+            with self._lock:
+                self._failed_count += 1
+            return
+        with self._lock:
+            if len(self._buffer) >= self._buffer_size:
+                self._dropped_count += 1
+                return
+            self._buffer.append(record)
+            self._recorded_count += 1
+        self._ensure_flusher()
+
+    def flush(self):
+        """
+        Writes all buffered records to the sink.
+
+        Batches that fail to be written are dropped and counted as failed.
+        """
+        with self._flush_lock:
+            while True:
+                with self._lock:
+                    records = [
+                        self._buffer.popleft()
+                        for _
+                        in range(min(self._batch_size, len(self._buffer)))
+                    ]
+                if not records:
+                    return
+                try:
+                    self._sink.write(records)
+                except Exception:
+                    logger.exception("Could not write %i token usage records", len(records))
+                    with self._lock:
+                        self._failed_count += len(records)
+
+    def info(self):
+        """
+        Returns the recorder statistics as a UsageRecorderInfo tuple.
+        """
+        with self._lock:
+            return UsageRecorderInfo(self._recorded_count, self._dropped_count, self._failed_count, len(self._buffer), self._buffer_size)
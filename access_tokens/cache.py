@@ -0,0 +1,78 @@
+"""
+Bounded in-process caching.
+"""
+
+import threading
+from collections import namedtuple, OrderedDict
+
+
+CacheInfo = namedtuple("CacheInfo", ("hits", "misses", "maxsize", "currsize",))
+
+
+class LRUCache(object):
+
+    """
+    A thread-safe mapping that holds at most `maxsize` items, discarding
+    the least recently used item when full.
+    """
+
+    def __init__(self, maxsize):
+        """Initializes the LRUCache."""
+        self._maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+
+    def get(self, key, default=None):
+        """
+        Returns the value for the given key, or the default if missing.
+        """
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                self._misses += 1
+                return default
+            self._data[key] = value
+            self._hits += 1
+            return value
+
+    def set(self, key, value):
+        """
+        Stores the value for the given key.
+        """
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+            while len(self._data) > self._maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        """
+        Removes the given key, if present.
+        """
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        """
+        Removes all items, and resets the hit and miss counts.
+        """
+        with self._lock:
+            self._data.clear()
+            self._hits = 0
+            self._misses = 0
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+    def info(self):
+        """
+        Returns the cache statistics as a CacheInfo tuple.
+        """
+        with self._lock:
+            return CacheInfo(self._hits, self._misses, self._maxsize, len(self._data))
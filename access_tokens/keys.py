@@ -0,0 +1,25 @@
+"""
+Signing key derivation.
+"""
+
+import binascii, hashlib, hmac
+
+from django.utils.encoding import force_bytes
+
+
+TENANT_KEY_SALT = b"access_tokens.tenant_key"
+
+
+def derive_tenant_key(master_key, tenant):
+    """
+    Derives a signing key for the given tenant from the master key,
+    using HKDF-SHA256 with the tenant as the context info.
+
+    Keys derived for different tenants are independent, so revealing one
+    tenant's key does not reveal the master key or any other tenant's key.
+    """
+    # HKDF extract.
+    pseudo_random_key = hmac.new(TENANT_KEY_SALT, force_bytes(master_key), hashlib.sha256).digest()
+    # HKDF expand, for a single block of output.
+    derived_key = hmac.new(pseudo_random_key, force_bytes(tenant) + b"\x01", hashlib.sha256).digest()
+    return binascii.hexlify(derived_key).decode("ascii")
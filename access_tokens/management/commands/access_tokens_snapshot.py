@@ -0,0 +1,39 @@
+"""
+Exports a read-only snapshot of the content type and permission ids
+used to compact scopes.
+"""
+
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS
+
+from access_tokens.snapshot import export_snapshot
+
+
+class Command(BaseCommand):
+
+    args = "[path]"
+
+    help = "Exports a codec snapshot to the given path, or the ACCESS_TOKENS_CODEC_SNAPSHOT setting."
+
+    option_list = BaseCommand.option_list + (
+        make_option("--database",
+            default = DEFAULT_DB_ALIAS,
+            help = "The database to read content types and permissions from. Defaults to the \"default\" database.",
+        ),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) > 1:
+            raise CommandError("Expected at most one path.")
+        if args:
+            path = args[0]
+        else:
+            path = getattr(settings, "ACCESS_TOKENS_CODEC_SNAPSHOT", None)
+            if path is None:
+                raise CommandError("No path given, and the ACCESS_TOKENS_CODEC_SNAPSHOT setting is not set.")
+        export_snapshot(path, using=options["database"])
+        if int(options.get("verbosity", 1)) >= 1:
+            self.stdout.write("Exported codec snapshot to {path}".format(path=path))
@@ -1 +1,45 @@
-# Required to be recognized as a Django app.
\ No newline at end of file
+"""
+Models used by access_tokens.
+
+The app does not require any tables to generate and validate tokens. The
+`ConsumedNonce` table is only used by `nonces.DatabaseNonceStore`, and the
+`TokenUsage` table is only used by `audit.ModelUsageSink`.
+"""
+
+from django.db import models
+
+
+class ConsumedNonce(models.Model):
+
+    """The nonce of a consumed single-use token."""
+
+    nonce = models.CharField(
+        max_length = 32,
+        primary_key = True,
+    )
+
+    expires = models.DateTimeField(
+        blank = True,
+        null = True,
+        db_index = True,
+    )
+
+
+class TokenUsage(models.Model):
+
+    """A record of a token being validated."""
+
+    token_digest = models.CharField(
+        max_length = 32,
+        db_index = True,
+    )
+
+    scope = models.TextField()
+
+    granted = models.BooleanField(
+        default = False,
+    )
+
+    timestamp = models.DateTimeField(
+        db_index = True,
+    )
@@ -0,0 +1,260 @@
+"""
+Storage for the nonces of consumed single-use tokens.
+
+A single-use token contains a random nonce. Consuming the token records
+its nonce in a nonce store, in a single atomic operation that fails if
+the nonce has already been recorded. Nonces are recorded for as long as
+the token could otherwise be valid, and then expire.
+
+Each store is split into shards, and nonces are assigned to a shard by
+their prefix.
+"""
+
+import heapq, itertools, threading, time, zlib
+from datetime import timedelta
+
+from django.db import transaction, IntegrityError, DEFAULT_DB_ALIAS
+from django.db.models import Q
+from django.utils import timezone
+
+from access_tokens.models import ConsumedNonce
+from access_tokens.references import get_cache, get_cache_timeout
+
+
+SHARD_PREFIX_LENGTH = 2
+
+
+def _get_shard(nonce, shard_count):
+    """
+    Returns the index of the shard that the given nonce is assigned to.
+    """
+    return zlib.crc32(nonce[:SHARD_PREFIX_LENGTH].encode("ascii")) % shard_count
+
+
+class NonceStore(object):
+
+    """
+    Records the nonces of consumed single-use tokens.
+
+    Subclasses must implement `consume` and `is_consumed`.
+    """
+
+    def consume(self, nonce, timeout=None):
+        """
+        Records the given nonce for `timeout` seconds, or forever if
+        timeout is None.
+
+        Returns True if the nonce was recorded, or False if it had already
+        been recorded.
+        """
+        raise NotImplementedError
+
+    def is_consumed(self, nonce):
+        """
+        Returns whether the given nonce has been recorded, and has not
+        yet expired.
+        """
+        raise NotImplementedError
+
+
+class _MemoryNonceShard(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.nonces = {}
+        self.expiries = []
+
+    def purge(self, now):
+        """
+        Forgets all nonces that have expired. Must be called with the
+        lock held.
+        """
+        while self.expiries and self.expiries[0][0] <= now:
+            expires, nonce = heapq.heappop(self.expiries)
+            if self.nonces.get(nonce) == expires:
+                del self.nonces[nonce]
+
+
+class MemoryNonceStore(NonceStore):
+
+    """
+    Records nonces in the memory of the current process.
+
+    Each shard has its own lock, so concurrent threads rarely contend.
+    Bear in mind that nonces are not shared between processes, so this
+    store is only suitable for single-process deployments and tests.
+    """
+
+    def __init__(self, shard_count=16):
+        """Initializes the MemoryNonceStore."""
+        self._shards = [
+            _MemoryNonceShard()
+            for _
+            in range(shard_count)
+        ]
+
+    def _get_shard(self, nonce):
+        return self._shards[_get_shard(nonce, len(self._shards))]
+
+    def consume(self, nonce, timeout=None):
+        """
+        Records the given nonce for `timeout` seconds, or forever if
+        timeout is None.
+
+        Returns True if the nonce was recorded, or False if it had already
+        been recorded.
+        """
+        shard = self._get_shard(nonce)
+        now = time.time()
+        with shard.lock:
+            shard.purge(now)
+            if nonce in shard.nonces:
+                return False
+            if timeout is None:
+                shard.nonces[nonce] = None
+            else:
+                expires = now + timeout
+                shard.nonces[nonce] = expires
+                heapq.heappush(shard.expiries, (expires, nonce))
+            return True
+
+    def is_consumed(self, nonce):
+        """
+        Returns whether the given nonce has been recorded, and has not
+        yet expired.
+        """
+        shard = self._get_shard(nonce)
+        with shard.lock:
+            shard.purge(time.time())
+            return nonce in shard.nonces
+
+
+class CacheNonceStore(NonceStore):
+
+    """
+    Records nonces in Django caches, sharded across the given cache aliases.
+
+    Nonces are recorded using the cache's atomic `add` operation, and
+    always need a timeout, so single-use tokens must be consumed with a
+    `max_age`. Bear in mind that a cache may evict nonces before their
+    timeout, allowing the corresponding tokens to be consumed again.
+    """
+
+    def __init__(self, cache_aliases=("default",), key_prefix="access_tokens.nonce:"):
+        """Initializes the CacheNonceStore."""
+        self._cache_aliases = tuple(cache_aliases)
+        self._key_prefix = key_prefix
+        self._caches = None
+
+    def _get_cache(self, nonce):
+        if self._caches is None:
+            self._caches = [
+                get_cache(cache_alias)
+                for cache_alias
+                in self._cache_aliases
+            ]
+        return self._caches[_get_shard(nonce, len(self._caches))]
+
+    def consume(self, nonce, timeout=None):
+        """
+        Records the given nonce for `timeout` seconds.
+
+        Returns True if the nonce was recorded, or False if it had already
+        been recorded. Raises ValueError if timeout is None, since not every
+        cache can reliably record a nonce forever.
+        """
+        if timeout is None:
+            raise ValueError("CacheNonceStore requires a timeout, so single-use tokens must be consumed with a max_age")
+        return self._get_cache(nonce).add(self._key_prefix + nonce, True, get_cache_timeout(timeout))
+
+    def is_consumed(self, nonce):
+        """
+        Returns whether the given nonce has been recorded, and has not
+        yet expired.
+        """
+        return self._get_cache(nonce).get(self._key_prefix + nonce) is not None
+
+
+def _insert_nonce(database, nonce, expires):
+    """
+    Inserts the given nonce, and returns False if it already exists.
+
+    A duplicate nonce only rolls back the insert, not any surrounding
+    transaction.
+    """
+    try:
+        atomic = transaction.atomic
+    except AttributeError:  # Django < 1.6
+        savepoint_id = transaction.savepoint(using=database)
+        try:
+            ConsumedNonce.objects.using(database).create(nonce=nonce, expires=expires)
+        except IntegrityError:
+            transaction.savepoint_rollback(savepoint_id, using=database)
+            return False
+        transaction.savepoint_commit(savepoint_id, using=database)
+        return True
+    try:
+        with atomic(using=database):
+            ConsumedNonce.objects.using(database).create(nonce=nonce, expires=expires)
+    except IntegrityError:
+        return False
+    return True
+
+
+class DatabaseNonceStore(NonceStore):
+
+    """
+    Records nonces in the `ConsumedNonce` model, sharded across the given
+    database aliases.
+
+    Nonces are recorded with a single insert, which fails on the unique
+    nonce column if the nonce has already been recorded. Every
+    `purge_interval` consumed nonces, expired nonces are deleted from the
+    shard being written to.
+    """
+
+    def __init__(self, databases=(DEFAULT_DB_ALIAS,), purge_interval=1000):
+        """Initializes the DatabaseNonceStore."""
+        self._databases = tuple(databases)
+        self._purge_interval = purge_interval
+        self._consume_counter = itertools.count(1)
+
+    def _get_database(self, nonce):
+        return self._databases[_get_shard(nonce, len(self._databases))]
+
+    def purge(self, database=None):
+        """
+        Deletes all expired nonces from the given database, or from every
+        shard if no database is given.
+        """
+        now = timezone.now()
+        for shard_database in (self._databases if database is None else (database,)):
+            ConsumedNonce.objects.using(shard_database).filter(expires__lte=now).delete()
+
+    def consume(self, nonce, timeout=None):
+        """
+        Records the given nonce for `timeout` seconds, or forever if
+        timeout is None.
+
+        Returns True if the nonce was recorded, or False if it had already
+        been recorded.
+        """
+        database = self._get_database(nonce)
+        if next(self._consume_counter) % self._purge_interval == 0:
+            self.purge(database)
+        now = timezone.now()
+        expires = None if timeout is None else now + timedelta(seconds=timeout)
+        if _insert_nonce(database, nonce, expires):
+            return True
+        # The nonce may have expired without being purged, in which case it can be recorded again.
+        return ConsumedNonce.objects.using(database).filter(nonce=nonce, expires__lte=now).update(expires=expires) == 1
+
+    def is_consumed(self, nonce):
+        """
+        Returns whether the given nonce has been recorded, and has not
+        yet expired.
+        """
+        return ConsumedNonce.objects.using(self._get_database(nonce)).filter(
+            Q(expires=None) | Q(expires__gt=timezone.now()),
+            nonce = nonce,
+        ).exists()
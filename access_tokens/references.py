@@ -0,0 +1,117 @@
+"""
+Storage for the scopes of reference tokens.
+
+A reference token contains only a short, signed, random reference. The
+serialized scope it grants is held in a reference store, and looked up
+when the token is validated.
+"""
+
+try:
+    from django.core.cache.backends.base import DEFAULT_TIMEOUT
+except ImportError:  # Django < 1.6
+    DEFAULT_TIMEOUT = None
+
+
+def get_cache(cache_alias):
+    """
+    Returns the Django cache with the given alias.
+    """
+    try:
+        from django.core.cache import caches
+    except ImportError:  # Django < 1.7
+        from django.core.cache import get_cache
+        return get_cache(cache_alias)
+    else:
+        return caches[cache_alias]
+
+
+def get_cache_timeout(timeout):
+    """
+    Returns the Django cache timeout for the given timeout in seconds, where
+    None means forever.
+
+    Django < 1.6 caches use their default timeout in place of None, and
+    cannot store values forever, so a timeout of None raises ValueError.
+    """
+    if timeout is None and DEFAULT_TIMEOUT is None:
+        raise ValueError("Django < 1.6 caches cannot store values forever, so a timeout is required")
+    return timeout
+
+
+class ReferenceStore(object):
+
+    """
+    Stores serialized scopes under their references.
+
+    Subclasses must implement `get_many` and `set`.
+    """
+
+    def get(self, reference):
+        """
+        Returns the serialized scope stored under the given reference,
+        or None if it is unknown or has expired.
+        """
+        return self.get_many((reference,)).get(reference)
+
+    def get_many(self, references):
+        """
+        Returns a dict of the serialized scopes stored under the given
+        references. Unknown or expired references are omitted.
+        """
+        raise NotImplementedError
+
+    def set(self, reference, serialized_scope, timeout=None):
+        """
+        Stores the serialized scope under the given reference, for
+        `timeout` seconds, or forever if timeout is None.
+        """
+        raise NotImplementedError
+
+
+class CacheReferenceStore(ReferenceStore):
+
+    """
+    Stores serialized scopes in a Django cache.
+
+    Bear in mind that a cache may evict references before their timeout,
+    causing validation of the corresponding tokens to fail. Django < 1.6
+    caches cannot store references forever, so require a timeout.
+    """
+
+    def __init__(self, cache_alias="default", key_prefix="access_tokens.reference:"):
+        """Initializes the CacheReferenceStore."""
+        self._cache_alias = cache_alias
+        self._key_prefix = key_prefix
+        self._cache = None
+
+    def _get_cache(self):
+        if self._cache is None:
+            self._cache = get_cache(self._cache_alias)
+        return self._cache
+
+    def get_many(self, references):
+        """
+        Returns a dict of the serialized scopes stored under the given
+        references. Unknown or expired references are omitted.
+        """
+        cached_scopes = self._get_cache().get_many([
+            self._key_prefix + reference
+            for reference
+            in references
+        ])
+        prefix_length = len(self._key_prefix)
+        return dict(
+            (cache_key[prefix_length:], serialized_scope)
+            for cache_key, serialized_scope
+            in cached_scopes.items()
+        )
+
+    def set(self, reference, serialized_scope, timeout=None):
+        """
+        Stores the serialized scope under the given reference, for
+        `timeout` seconds, or forever if timeout is None.
+
+        Raises ValueError if timeout is None and the cache cannot store
+        values forever.
+        """
+        self._get_cache().set(self._key_prefix + reference, serialized_scope, get_cache_timeout(timeout))
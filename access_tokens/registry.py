@@ -0,0 +1,230 @@
+"""
+Named scope templates.
+
+A scope template is a scope registered under a name and a small integer
+id. Model grants in the template may contain the `PK` placeholder, which
+is bound to an object pk when the template is used:
+
+    registry.register(1, "read_document", (
+        (("docs", "document", registry.PK), ("read",)),
+    ))
+
+    token = tokens.generate(registry.bind("read_document", document.pk))
+
+Templates are precompiled when registered. A token generator whose scope
+serializer includes `RegisteredScopeSerializerMixin` serializes a bound
+template as just its id and pks.
+
+Templates can also be declared in the `ACCESS_TOKENS_SCOPE_TEMPLATES`
+setting, as a sequence of `(template_id, name, template_scope)` tuples,
+using the string ``"<pk>"`` as the placeholder.
+"""
+
+import threading
+
+from django.conf import settings
+
+from access_tokens.scope import _compile_permissions_grant, DefaultScopeSerializer
+
+
+PK = "<pk>"
+
+
+class RegistrationError(Exception):
+
+    """Something went wrong when registering a scope template."""
+
+
+class BoundScope(tuple):
+
+    """
+    A scope created by binding a scope template to some pks.
+
+    Bound scopes behave as ordinary scopes, but remember the template
+    and pks used to create them.
+    """
+
+    def __new__(cls, grants, template, pks):
+        bound_scope = super(BoundScope, cls).__new__(cls, grants)
+        bound_scope.template = template
+        bound_scope.pks = pks
+        return bound_scope
+
+
+class ScopeTemplate(object):
+
+    """A precompiled scope template."""
+
+    def __init__(self, template_id, name, template_scope):
+        """Initializes the ScopeTemplate."""
+        self.template_id = template_id
+        self.name = name
+        self._grants = tuple(
+            (tuple(model_grant), _compile_permissions_grant(permissions_grant))
+            for model_grant, permissions_grant
+            in template_scope
+        )
+        self.pk_count = sum(
+            list(model_grant).count(PK)
+            for model_grant, permissions_grant
+            in self._grants
+        )
+
+    def bind(self, *pks):
+        """
+        Returns a BoundScope with each placeholder replaced by the
+        corresponding pk.
+        """
+        if len(pks) != self.pk_count:
+            raise TypeError("Scope template %r requires %i pks, got %i" % (self.name, self.pk_count, len(pks)))
+        if not pks:
+            return BoundScope(self._grants, self, pks)
+        pks_iter = iter(pks)
+        grants = []
+        for model_grant, permission_index in self._grants:
+            if PK in model_grant:
+                model_grant = tuple(
+                    next(pks_iter) if model_grant_part == PK else model_grant_part
+                    for model_grant_part
+                    in model_grant
+                )
+            grants.append((model_grant, permission_index))
+        return BoundScope(grants, self, pks)
+
+
+class ScopeRegistry(object):
+
+    """A registry of scope templates."""
+
+    def __init__(self):
+        """Initializes the ScopeRegistry."""
+        self._templates_by_id = {}
+        self._templates_by_name = {}
+        self._settings_loaded = False
+        self._lock = threading.Lock()
+
+    def _load_settings(self):
+        """
+        Registers the templates declared in settings, the first time
+        the registry is used.
+        """
+        if not self._settings_loaded:
+            with self._lock:
+                if not self._settings_loaded:
+                    for template_id, name, template_scope in getattr(settings, "ACCESS_TOKENS_SCOPE_TEMPLATES", ()):
+                        self._register(template_id, name, template_scope)
+                    self._settings_loaded = True
+
+    def _register(self, template_id, name, template_scope):
+        if template_id in self._templates_by_id:
+            raise RegistrationError("Scope template id %r is already registered" % template_id)
+        if name in self._templates_by_name:
+            raise RegistrationError("Scope template %r is already registered" % name)
+        template = ScopeTemplate(template_id, name, template_scope)
+        self._templates_by_id[template_id] = template
+        self._templates_by_name[name] = template
+        return template
+
+    def register(self, template_id, name, template_scope):
+        """
+        Registers the given scope as a template with the given id and name.
+
+        Template ids are included in tokens, so must not be reused for a
+        different template while tokens using them are still valid.
+        """
+        if not isinstance(template_id, int):
+            raise RegistrationError("Scope template ids must be integers")
+        self._load_settings()
+        with self._lock:
+            return self._register(template_id, name, template_scope)
+
+    def get_template(self, name):
+        """
+        Returns the template registered under the given name.
+
+        Raises KeyError if no template is registered under the name.
+        """
+        self._load_settings()
+        return self._templates_by_name[name]
+
+    def get_template_by_id(self, template_id):
+        """
+        Returns the template registered under the given id, or None if no
+        template is registered under the id.
+        """
+        self._load_settings()
+        return self._templates_by_id.get(template_id)
+
+    def bind(self, name, *pks):
+        """
+        Returns a scope created by binding the named template to the
+        given pks.
+        """
+        return self.get_template(name).bind(*pks)
+
+
+class RegisteredScopeSerializerMixin(object):
+
+    """
+    A mixin for a ScopeSerializer that serializes bound scope templates
+    as their template id and pks.
+    """
+
+    scope_registry = None
+
+    def __init__(self):
+        """
+        Initializes the RegisteredScopeSerializerMixin.
+        """
+        super(RegisteredScopeSerializerMixin, self).__init__()
+        if self.scope_registry is None:
+            self.scope_registry = default_scope_registry
+
+    def get_scope_protocol_version(self):
+        """
+        Returns the scope protocol version, which is incorporated
+        in the token generator's salt.
+        """
+        return super(RegisteredScopeSerializerMixin, self).get_scope_protocol_version() + "+registry"
+
+    def serialize_scope(self, scope):
+        """
+        Returns a compact representation of the given scope.
+        """
+        if isinstance(scope, BoundScope) and self.scope_registry.get_template_by_id(scope.template.template_id) is scope.template:
+            return [scope.template.template_id] + list(scope.pks)
+        return super(RegisteredScopeSerializerMixin, self).serialize_scope(scope)
+
+    def iter_deserialize_scope(self, serialized_scope):
+        """
+        Lazily converts the serialized scope into a correctly-formatted scope.
+
+        Scopes referring to an unknown template grant nothing.
+        """
+        if serialized_scope and not isinstance(serialized_scope[0], (list, tuple)):
+            template = self.scope_registry.get_template_by_id(serialized_scope[0])
+            if template is None or len(serialized_scope) - 1 != template.pk_count:
+                return iter(())
+            return iter(template.bind(*serialized_scope[1:]))
+        return super(RegisteredScopeSerializerMixin, self).iter_deserialize_scope(serialized_scope)
+
+
+class RegisteredScopeSerializer(RegisteredScopeSerializerMixin, DefaultScopeSerializer):
+
+    """
+    A DefaultScopeSerializer that serializes bound scope templates
+    as their template id and pks.
+    """
+
+
+# Instantiate a shared default scope registry.
+
+
+default_scope_registry = ScopeRegistry()
+
+
+# Create shortcut methods for the default scope registry.
+
+
+register = default_scope_registry.register
+bind = default_scope_registry.bind
@@ -1,18 +1,46 @@
 """
 Scope generation, comparison and serialization.
 
-The methods `access_obj`, `access_model`, `access_app` and `access_all`
-can be used to generate a scope that represents access to the specified
-model instance, model, app or globally.
+The methods `access_obj`, `access_objs`, `access_model`, `access_app` and
+`access_all` can be used to generate a scope that represents access to the
+specified model instance, set of model instances, model, app or globally.
 
 Scopes can be appended to each other using the plus operator, allowing
 multiple scopes to be combined.
+
+Permission grants may contain ``*`` wildcards, such as ``"blog.*"`` or
+``"*.view_*"``, which match any run of characters.
 """
 
-from itertools import chain, izip_longest
+import threading
+from bisect import bisect_right
+from itertools import imap, izip_longest
 
 from django.conf import settings
 
+try:
+    from django.db.models.signals import post_migrate
+except ImportError:  # Django < 1.7
+    from django.db.models.signals import post_syncdb as post_migrate
+
+from access_tokens.snapshot import get_snapshot
+
+
+try:
+    string_types = (str, unicode)
+except NameError:  # Python 3
+    string_types = (str,)
+
+try:
+    integer_types = (int, long)
+except NameError:  # Python 3
+    integer_types = (int,)
+
+try:
+    intern
+except NameError:  # Python 3
+    from sys import intern
+
 
 # Scope generation.
 
@@ -46,6 +74,92 @@ def access_obj(obj, *permissions):
     )
 
 
+class PkSet(tuple):
+
+    """
+    A sorted set of object pks, compressed into runs.
+
+    Each item is either a single pk, or a `(first_pk, last_pk)` tuple
+    for a run of contiguous integer pks. Membership is checked by binary
+    search over the runs.
+    """
+
+    def __new__(cls, runs=()):
+        runs = tuple(
+            tuple(run) if isinstance(run, (list, tuple)) else run
+            for run
+            in runs
+        )
+        pk_set = super(PkSet, cls).__new__(cls, runs)
+        pk_set._firsts = [run[0] if isinstance(run, tuple) else run for run in runs]
+        pk_set._lasts = [run[1] if isinstance(run, tuple) else run for run in runs]
+        return pk_set
+
+    @classmethod
+    def from_pks(cls, pks):
+        """
+        Returns a PkSet containing the given pks.
+        """
+        runs = []
+        first_pk = last_pk = None
+        for pk in sorted(set(pks)):
+            if last_pk is not None and isinstance(pk, integer_types) and isinstance(last_pk, integer_types) and pk == last_pk + 1:
+                last_pk = pk
+                continue
+            if last_pk is not None:
+                runs.append(first_pk if first_pk == last_pk else (first_pk, last_pk))
+            first_pk = last_pk = pk
+        if last_pk is not None:
+            runs.append(first_pk if first_pk == last_pk else (first_pk, last_pk))
+        return cls(runs)
+
+    def _find_run(self, pk):
+        """
+        Returns the index of the run containing the given pk, or None.
+        """
+        try:
+            index = bisect_right(self._firsts, pk) - 1
+            if index >= 0 and pk <= self._lasts[index]:
+                return index
+        except TypeError:  # Python 3 pks of different types.
+            pass
+        return None
+
+    def __contains__(self, pk):
+        return self._find_run(pk) is not None
+
+    def issubset(self, other):
+        """
+        Returns True if every pk in this PkSet is in the other PkSet.
+        """
+        for first_pk, last_pk in zip(self._firsts, self._lasts):
+            index = other._find_run(first_pk)
+            if index is None or last_pk > other._lasts[index]:
+                return False
+        return True
+
+
+def access_objs(model_or_queryset, *permissions):
+    """
+    Returns a scope that represents access for the given
+    permissions to every object in the given queryset, or model.
+
+    The object pks are stored as a single compressed PkSet.
+    """
+    if hasattr(model_or_queryset, "_default_manager"):
+        queryset = model_or_queryset._default_manager.all()
+    else:
+        queryset = model_or_queryset
+    return _make_grant(
+        (
+            queryset.model._meta.app_label,
+            get_model_name(queryset.model._meta),
+            PkSet.from_pks(queryset.values_list("pk", flat=True)),
+        ),
+        permissions,
+    )
+
+
 def access_model(model, *permissions):
     """
     Returns a scope that represents access for the given
@@ -87,30 +201,189 @@ def access_all(*permissions):
 # Scope comparison.
 
 
+class _PermissionTrieNode(object):
+
+    """A node in the wildcard permission trie."""
+
+    __slots__ = ("children", "star", "is_star", "is_terminal",)
+
+    def __init__(self, is_star=False):
+        self.children = {}
+        self.star = None
+        self.is_star = is_star
+        self.is_terminal = False
+
+
+def _expand_permission_trie_nodes(nodes):
+    """
+    Adds the wildcard nodes reachable from the given nodes without
+    consuming any characters.
+    """
+    pending = list(nodes)
+    while pending:
+        node = pending.pop()
+        if node.star is not None and node.star not in nodes:
+            nodes.add(node.star)
+            pending.append(node.star)
+    return nodes
+
+
+class _PermissionIndex(object):
+
+    """
+    A precompiled permissions grant.
+
+    Exact permissions are looked up in a set, and wildcard permissions
+    are matched against a character trie, so the cost of a lookup
+    depends on the length of the permission, not the number of
+    wildcard permissions in the grant.
+    """
+
+    def __init__(self, permissions_grant):
+        """Initializes the _PermissionIndex."""
+        self._permissions = frozenset(permissions_grant)
+        self._trie = None
+        for permission in self._permissions:
+            if isinstance(permission, string_types) and "*" in permission:
+                self._add_wildcard_permission(permission)
+
+    def _add_wildcard_permission(self, permission):
+        if self._trie is None:
+            self._trie = _PermissionTrieNode()
+        node = self._trie
+        for char in permission:
+            if char == "*":
+                if not node.is_star:
+                    if node.star is None:
+                        node.star = _PermissionTrieNode(is_star=True)
+                    node = node.star
+            else:
+                node = node.children.setdefault(char, _PermissionTrieNode())
+        node.is_terminal = True
+
+    def _match_wildcard_permission(self, permission):
+        nodes = _expand_permission_trie_nodes(set((self._trie,)))
+        for char in permission:
+            next_nodes = set()
+            for node in nodes:
+                if node.is_star:
+                    next_nodes.add(node)
+                child = node.children.get(char)
+                if child is not None:
+                    next_nodes.add(child)
+            if not next_nodes:
+                return False
+            nodes = _expand_permission_trie_nodes(next_nodes)
+        return any(node.is_terminal for node in nodes)
+
+    def __iter__(self):
+        return iter(self._permissions)
+
+    def __len__(self):
+        return len(self._permissions)
+
+    def __contains__(self, permission):
+        if permission in self._permissions:
+            return True
+        if self._trie is None or not isinstance(permission, string_types):
+            return False
+        return self._match_wildcard_permission(permission)
+
+
+_PERMISSION_INDEX_CACHE_SIZE = 1024
+
+_permission_index_cache = {}
+
+
+def _compile_permissions_grant(permissions_grant):
+    """
+    Returns a _PermissionIndex for the given permissions grant,
+    reusing a previously compiled index where possible.
+    """
+    if isinstance(permissions_grant, _PermissionIndex):
+        return permissions_grant
+    permissions_grant = frozenset(permissions_grant)
+    permission_index = _permission_index_cache.get(permissions_grant)
+    if permission_index is None:
+        permission_index = _PermissionIndex(permissions_grant)
+        if len(_permission_index_cache) >= _PERMISSION_INDEX_CACHE_SIZE:
+            _permission_index_cache.clear()
+        _permission_index_cache[permissions_grant] = permission_index
+    return permission_index
+
+
+def _is_sub_model_grant_part(model_grant_part, parent_model_grant_part):
+    """
+    Returns True if the given model grant part is covered by the
+    parent model grant part, either of which may be a PkSet.
+    """
+    if parent_model_grant_part == model_grant_part:
+        return True
+    if isinstance(parent_model_grant_part, PkSet):
+        if isinstance(model_grant_part, PkSet):
+            return model_grant_part.issubset(parent_model_grant_part)
+        return model_grant_part in parent_model_grant_part
+    if isinstance(model_grant_part, PkSet):
+        return model_grant_part.issubset(PkSet((parent_model_grant_part,)))
+    return False
+
+
+def _is_sub_model_grant(model_grant, parent_model_grant):
+    """
+    Returns True if the given model grant is covered by the
+    parent model grant.
+    """
+    return all(
+        _is_sub_model_grant_part(model_grant_part, parent_model_grant_part)
+        for model_grant_part, parent_model_grant_part
+        in izip_longest(
+            model_grant,
+            parent_model_grant,
+        )
+        if parent_model_grant_part is not None
+    )
+
+
 def _is_sub_scope(scope, parent_scope):
     """
     Returns True if the given scope is a subset of the permissions
     defined in the parent scope.
+
+    The parent scope is consumed one grant at a time, stopping as soon
+    as every requested permission has been granted. The permissions of a
+    parent grant are only read if its model grant covers an outstanding
+    requested grant, so the parent scope may be a lazy iterable.
     """
-    return not any (
-        frozenset(permissions_grant).difference(chain.from_iterable(
-            parent_permissions_grant
-            for parent_model_grant, parent_permissions_grant
-            in parent_scope
-            if all(
-                parent_model_grant_part == model_grant_part
-                for model_grant_part, parent_model_grant_part
-                in izip_longest(
-                    model_grant,
-                    parent_model_grant,
-                )
-                if parent_model_grant_part is not None
-            )
-        ))
+    outstanding_grants = [
+        (model_grant, set(permissions_grant))
         for model_grant, permissions_grant
         in scope
         if permissions_grant
-    )
+    ]
+    if not outstanding_grants:
+        return True
+    for parent_model_grant, parent_permissions_grant in parent_scope:
+        parent_permission_index = None
+        for model_grant, outstanding_permissions in outstanding_grants:
+            if _is_sub_model_grant(model_grant, parent_model_grant):
+                if parent_permission_index is None:
+                    parent_permission_index = _compile_permissions_grant(parent_permissions_grant)
+                outstanding_permissions.difference_update([
+                    permission
+                    for permission
+                    in outstanding_permissions
+                    if permission in parent_permission_index
+                ])
+        if parent_permission_index is not None:
+            outstanding_grants = [
+                (model_grant, outstanding_permissions)
+                for model_grant, outstanding_permissions
+                in outstanding_grants
+                if outstanding_permissions
+            ]
+            if not outstanding_grants:
+                return True
+    return False
 
 
 # Scope serialization and deserialization.
@@ -175,17 +448,32 @@ class ScopeSerializer(object):
         """
         return serialized_permission_grant
 
+    def iter_deserialize_scope(self, serialized_scope):
+        """
+        Lazily converts the serialized scope into a correctly-formatted scope.
+
+        Grants are deserialized one at a time as the scope is iterated, and
+        the permissions of each grant are only deserialized when they are
+        iterated.
+        """
+        for serialized_model_grant, serialized_permissions_grant in serialized_scope:
+            model_grant = self.deserialize_model_grant(serialized_model_grant)
+            # Restore PkSets, which are serialized as lists.
+            if len(model_grant) > 2 and isinstance(model_grant[2], list):
+                model_grant = tuple(model_grant[:2]) + (PkSet(model_grant[2]),) + tuple(model_grant[3:])
+            yield (
+                model_grant,
+                imap(self.deserialize_permission_grant, serialized_permissions_grant),
+            )
+
     def deserialize_scope(self, serialized_scope):
         """
         Converts the serialized scope into a correctly-formatted scope.
         """
         return [
-            (
-                self.deserialize_model_grant(serialized_model_grant),
-                map(self.deserialize_permission_grant, serialized_permissions_grant),
-            )
-            for serialized_model_grant, serialized_permissions_grant
-            in serialized_scope
+            (model_grant, list(permissions_grant))
+            for model_grant, permissions_grant
+            in self.iter_deserialize_scope(serialized_scope)
         ]
 
 
@@ -194,6 +482,15 @@ class ContentTypeScopeSerializerMixin(object):
     """
     A mixin for a ScopeSerializer that provides a more compact
     representation of model grants by using the ContentTypes framework.
+
+    Content types are looked up in tables loaded from the codec snapshot,
+    if one is configured, or from the database in a single query on
+    first use. The tables hold interned tuples, so translating a model
+    grant is a dictionary lookup. They are reloaded after migrations.
+
+    Content types missing from a valid codec snapshot are never looked up
+    in the database. Their model grants are left uncompacted, and their ids
+    grant nothing.
     """
 
     def __init__(self):
@@ -204,13 +501,74 @@ class ContentTypeScopeSerializerMixin(object):
         # Lazy-load content type model.
         from django.contrib.contenttypes.models import ContentType
         self._content_type_model = ContentType
+        self._content_type_tables = None
+        self._content_type_tables_lock = threading.Lock()
+        post_migrate.connect(self._clear_content_type_cache_after_migrate)
+
+    def _add_content_type(self, content_type_tables, content_type_id, app_label, model_name):
+        serialized_model_grants, model_grants, from_snapshot = content_type_tables
+        model_grant = (intern(str(app_label)), intern(str(model_name)),)
+        serialized_model_grants[model_grant] = (content_type_id,)
+        model_grants[content_type_id] = model_grant
+
+    def _load_content_type_tables(self):
+        """
+        Loads the `(app_label, model_name) -> (id,)` and
+        `id -> (app_label, model_name)` tables from the codec snapshot,
+        or the database, along with whether they came from the snapshot.
+        """
+        snapshot = get_snapshot()
+        content_type_tables = ({}, {}, snapshot is not None)
+        if snapshot is None:
+            content_types = self._content_type_model.objects.values_list("id", "app_label", "model").iterator()
+        else:
+            content_types = (
+                (content_type_id, app_label, model_name)
+                for content_type_id, (app_label, model_name)
+                in snapshot.content_types.items()
+            )
+        for content_type_id, app_label, model_name in content_types:
+            self._add_content_type(content_type_tables, content_type_id, app_label, model_name)
+        return content_type_tables
+
+    def _get_content_type_tables(self):
+        content_type_tables = self._content_type_tables
+        if content_type_tables is None:
+            with self._content_type_tables_lock:
+                content_type_tables = self._content_type_tables
+                if content_type_tables is None:
+                    content_type_tables = self._content_type_tables = self._load_content_type_tables()
+        return content_type_tables
+
+    def clear_content_type_cache(self):
+        """
+        Clears the content type lookup tables, so that they are reloaded
+        on next use.
+        """
+        self._content_type_tables = None
+
+    def _clear_content_type_cache_after_migrate(self, **kwargs):
+        self.clear_content_type_cache()
 
     def serialize_model_grant(self, model_grant):
         """
         Returns a compact representation of the given model grant.
         """
         if len(model_grant) >= 2:
-            return (self._content_type_model.objects.get_by_natural_key(*model_grant[:2]).id,) + model_grant[2:]
+            content_type_tables = self._get_content_type_tables()
+            natural_key = tuple(model_grant[:2])
+            serialized_model_grant = content_type_tables[0].get(natural_key)
+            if serialized_model_grant is None:
+                if content_type_tables[2]:
+                    return model_grant
+                # The content type may have been created since the tables were loaded.
+                content_type = self._content_type_model.objects.get_by_natural_key(*natural_key)
+                with self._content_type_tables_lock:
+                    self._add_content_type(content_type_tables, content_type.id, content_type.app_label, content_type.model)
+                serialized_model_grant = (content_type.id,)
+            if len(model_grant) == 2:
+                return serialized_model_grant
+            return serialized_model_grant + tuple(model_grant[2:])
         return model_grant
 
     def deserialize_model_grant(self, serialized_model_grant):
@@ -219,16 +577,38 @@ class ContentTypeScopeSerializerMixin(object):
         model grant.
         """
         if serialized_model_grant and isinstance(serialized_model_grant[0], int):
-            model = self._content_type_model.objects.get_for_id(serialized_model_grant[0]).model_class()
-            return [
-                model._meta.app_label,
-                get_model_name(model._meta),
-            ] + serialized_model_grant[1:]
+            content_type_tables = self._get_content_type_tables()
+            model_grant = content_type_tables[1].get(serialized_model_grant[0])
+            if model_grant is None:
+                if content_type_tables[2]:
+                    return tuple(serialized_model_grant)
+                # The content type may have been created since the tables were loaded.
+                content_type = self._content_type_model.objects.get_for_id(serialized_model_grant[0])
+                with self._content_type_tables_lock:
+                    self._add_content_type(content_type_tables, content_type.id, content_type.app_label, content_type.model)
+                model_grant = content_type_tables[1][content_type.id]
+            if len(serialized_model_grant) == 1:
+                return model_grant
+            return model_grant + tuple(serialized_model_grant[1:])
         return serialized_model_grant
 
 
 class AuthPermissionScopeSerializerMixin(object):
 
+    """
+    A mixin for a ScopeSerializer that provides a more compact
+    representation of permission grants by using the auth framework.
+
+    Permissions are looked up in tables loaded from the codec snapshot,
+    if one is configured, or from the database in a single query on
+    first use, so the number of queries does not grow with the number of
+    permissions in a scope.
+
+    Permissions missing from a valid codec snapshot are never looked up in
+    the database. Their names are left uncompacted, and their ids grant
+    nothing.
+    """
+
     def __init__(self):
         """
         Initializes the AuthPermissionScopeSerializerMixin.
@@ -237,26 +617,72 @@ class AuthPermissionScopeSerializerMixin(object):
         # Lazy-load Permission model.
         from django.contrib.auth.models import Permission
         self._permission_model = Permission
+        self._permission_tables = None
+        self._permission_tables_lock = threading.Lock()
+        self._missing_permission_ids = set()
+        post_migrate.connect(self._clear_permission_cache_after_migrate)
+
+    def _load_permission_tables(self):
+        """
+        Loads the `app_label.codename -> id` and `id -> app_label.codename`
+        tables from the codec snapshot, or the database, along with whether
+        they came from the snapshot.
+
+        Permission names shared by several permissions are left out of the
+        `app_label.codename -> id` table, since they cannot be compacted
+        unambiguously.
+        """
+        permission_ids = {}
+        permission_names = {}
+        ambiguous_permission_names = set()
+        snapshot = get_snapshot()
+        if snapshot is None:
+            permissions = (
+                (permission_id, "%s.%s" % (app_label, codename))
+                for permission_id, app_label, codename
+                in self._permission_model.objects.values_list("id", "content_type__app_label", "codename").iterator()
+            )
+        else:
+            permissions = snapshot.permissions.items()
+        for permission_id, permission_name in permissions:
+            if permission_name in permission_ids:
+                ambiguous_permission_names.add(permission_name)
+            permission_ids[permission_name] = permission_id
+            permission_names[permission_id] = permission_name
+        for permission_name in ambiguous_permission_names:
+            del permission_ids[permission_name]
+        return permission_ids, permission_names, snapshot is not None
+
+    def _get_permission_tables(self):
+        permission_tables = self._permission_tables
+        if permission_tables is None:
+            with self._permission_tables_lock:
+                permission_tables = self._permission_tables
+                if permission_tables is None:
+                    permission_tables = self._permission_tables = self._load_permission_tables()
+        return permission_tables
+
+    def clear_permission_cache(self):
+        """
+        Clears the permission lookup tables, so that they are reloaded
+        from the database on next use.
+        """
+        self._permission_tables = None
+        self._missing_permission_ids = set()
+
+    def _clear_permission_cache_after_migrate(self, **kwargs):
+        self.clear_permission_cache()
 
     def serialize_permission_grant(self, permission_grant):
         """
         Returns a compact representation of the given permission grant.
+
+        Wildcard permission grants are left as they are.
         """
-        try:
-            app_label, codename = permission_grant.split(".")
-        except ValueError:
-            pass
-        else:
-            try:
-                permission = self._permission_model.objects.get(
-                    content_type__app_label = app_label,
-                    codename = codename,
-                )
-            except (self._permission_model.DoesNotExist, self._permission_model.MultipleObjectsReturned):
-                pass
-            else:
-                return permission.id
-        return permission_grant
+        if "*" in permission_grant or "." not in permission_grant:
+            return permission_grant
+        permission_ids, permission_names, from_snapshot = self._get_permission_tables()
+        return permission_ids.get(permission_grant, permission_grant)
 
     def deserialize_permission_grant(self, serialized_permission_grant):
         """
@@ -264,7 +690,19 @@ class AuthPermissionScopeSerializerMixin(object):
         permission grant.
         """
         if isinstance(serialized_permission_grant, int):
-            return self._permission_model.objects.get(id=serialized_permission_grant)
+            permission_ids, permission_names, from_snapshot = self._get_permission_tables()
+            try:
+                return permission_names[serialized_permission_grant]
+            except KeyError:
+                if from_snapshot or serialized_permission_grant in self._missing_permission_ids:
+                    return serialized_permission_grant
+                # The permission may have been created since the tables were loaded, so reload
+                # them once. Ids that are still missing are remembered, and not reloaded again.
+                with self._permission_tables_lock:
+                    permission_ids, permission_names, from_snapshot = self._permission_tables = self._load_permission_tables()
+                    if serialized_permission_grant not in permission_names:
+                        self._missing_permission_ids.add(serialized_permission_grant)
+                return permission_names.get(serialized_permission_grant, serialized_permission_grant)
         return serialized_permission_grant
 
 
@@ -0,0 +1,187 @@
+"""
+Read-only snapshots of the content type and permission ids used to
+compact scopes.
+
+A snapshot is exported by the `access_tokens_snapshot` management
+command, and its path set in the `ACCESS_TOKENS_CODEC_SNAPSHOT` setting.
+Each worker process then reads the snapshot once, instead of loading the
+ids from the database.
+
+While a valid snapshot is in use, it is the only source of ids, so every
+process reading the same snapshot reads each id the same way. Ids are
+never looked up in the database, even if they are missing from the
+snapshot.
+
+A snapshot records a fingerprint of the installed models and their
+permissions. If the snapshot is missing, malformed, or its fingerprint no
+longer matches, a warning is logged and ids are loaded from the database
+instead, as if no snapshot was configured.
+"""
+
+import hashlib, logging, os, tempfile, threading
+
+from django.conf import settings
+
+try:
+    from django.apps import apps
+    get_models = apps.get_models
+except ImportError:  # Django < 1.7
+    from django.db.models import get_models
+
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+
+SNAPSHOT_FORMAT_VERSION = "1"
+
+SNAPSHOT_HEADER = "access_tokens.codec_snapshot"
+
+DEFAULT_PERMISSIONS = ("add", "change", "delete",)
+
+
+def get_schema_fingerprint():
+    """
+    Returns a fingerprint of the installed models and their permissions,
+    which determine the content types and permissions in the database.
+    """
+    schema = sorted(
+        "%s.%s:%s" % (
+            model._meta.app_label,
+            model._meta.object_name.lower(),
+            ",".join(sorted(
+                [
+                    "%s_%s" % (action, model._meta.object_name.lower())
+                    for action
+                    in getattr(model._meta, "default_permissions", DEFAULT_PERMISSIONS)
+                ] + [
+                    codename
+                    for codename, name
+                    in model._meta.permissions
+                ]
+            )),
+        )
+        for model
+        in get_models()
+    )
+    return hashlib.sha1("\n".join(schema).encode("utf-8")).hexdigest()
+
+
+class CodecSnapshot(object):
+
+    """
+    The content type and permission ids loaded from a snapshot.
+    """
+
+    def __init__(self, content_types, permissions):
+        """Initializes the CodecSnapshot."""
+        self.content_types = content_types
+        self.content_type_ids = dict(
+            (natural_key, content_type_id)
+            for content_type_id, natural_key
+            in content_types.items()
+        )
+        self.permissions = permissions
+
+
+def export_snapshot(path, using=None):
+    """
+    Writes a snapshot of the content type and permission ids in the
+    given database to the given path.
+
+    The snapshot is written to a temporary file and moved into place,
+    so running processes never see a partly-written snapshot.
+    """
+    lines = [" ".join((SNAPSHOT_HEADER, SNAPSHOT_FORMAT_VERSION, get_schema_fingerprint()))]
+    if "django.contrib.contenttypes" in settings.INSTALLED_APPS:
+        from django.contrib.contenttypes.models import ContentType
+        lines.extend(
+            "\t".join(("c", str(content_type_id), app_label, model))
+            for content_type_id, app_label, model
+            in ContentType.objects.using(using).order_by("id").values_list("id", "app_label", "model")
+        )
+    if "django.contrib.auth" in settings.INSTALLED_APPS:
+        from django.contrib.auth.models import Permission
+        lines.extend(
+            "\t".join(("p", str(permission_id), app_label, codename))
+            for permission_id, app_label, codename
+            in Permission.objects.using(using).order_by("id").values_list("id", "content_type__app_label", "codename")
+        )
+    data = ("\n".join(lines) + "\n").encode("utf-8")
+    directory = os.path.dirname(os.path.abspath(path))
+    handle, temp_path = tempfile.mkstemp(dir=directory, prefix=".access_tokens_snapshot")
+    try:
+        with os.fdopen(handle, "wb") as temp_file:
+            temp_file.write(data)
+        os.chmod(temp_path, 0o444)
+        os.rename(temp_path, path)
+    except Exception:
+        os.remove(temp_path)
+        raise
+
+
+def load_snapshot(path):
+    """
+    Reads the snapshot at the given path, and returns a CodecSnapshot, or
+    None if the snapshot is missing, malformed or stale.
+    """
+    try:
+        with open(path, "rb") as snapshot_file:
+            lines = snapshot_file.read().decode("utf-8").splitlines()
+        if not lines or lines[0].split() != [SNAPSHOT_HEADER, SNAPSHOT_FORMAT_VERSION, get_schema_fingerprint()]:
+            logger.warning("Codec snapshot %s is malformed or stale", path)
+            return None
+        content_types = {}
+        permissions = {}
+        for line in lines[1:]:
+            kind, id, app_label, name = line.split("\t")
+            if kind == "c":
+                content_types[int(id)] = (app_label, name)
+            elif kind == "p":
+                permissions[int(id)] = "%s.%s" % (app_label, name)
+            else:
+                raise ValueError("Unknown snapshot line kind %r" % kind)
+    except (EnvironmentError, ValueError) as ex:
+        logger.warning("Could not load codec snapshot %s: %s", path, ex)
+        return None
+    return CodecSnapshot(content_types, permissions)
+
+
+_snapshots = {}
+
+_snapshots_lock = threading.Lock()
+
+
+def get_snapshot():
+    """
+    Returns the CodecSnapshot at the path given by the
+    `ACCESS_TOKENS_CODEC_SNAPSHOT` setting, or None if the setting is
+    not set, or the snapshot is missing, malformed or stale.
+
+    Each snapshot is only loaded once per process, unless the file is
+    replaced, so a newly exported snapshot is picked up without a restart.
+    """
+    path = getattr(settings, "ACCESS_TOKENS_CODEC_SNAPSHOT", None)
+    if path is None:
+        return None
+    try:
+        snapshot_stat = os.stat(path)
+    except EnvironmentError as ex:
+        logger.warning("Could not load codec snapshot %s: %s", path, ex)
+        return None
+    file_key = (snapshot_stat.st_ino, snapshot_stat.st_size, snapshot_stat.st_mtime)
+    cached_snapshot = _snapshots.get(path)
+    if cached_snapshot is None or cached_snapshot[0] != file_key:
+        with _snapshots_lock:
+            cached_snapshot = _snapshots.get(path)
+            if cached_snapshot is None or cached_snapshot[0] != file_key:
+                cached_snapshot = _snapshots[path] = (file_key, load_snapshot(path))
+    return cached_snapshot[1]
+
+
+def clear_snapshot_cache():
+    """
+    Forgets all loaded snapshots, so they are reloaded on next use.
+    """
+    with _snapshots_lock:
+        _snapshots.clear()
@@ -0,0 +1,104 @@
+"""
+Test helpers for checking the database cost of token-protected code.
+
+Mix `QueryBudgetTestMixin` into a `django.test.TestCase` to assert that
+token generation, validation, or whole views stay within a query budget,
+and that the number of queries does not grow with the size of a scope.
+"""
+
+from django.core.signals import request_started
+from django.db import connections, reset_queries, DEFAULT_DB_ALIAS
+
+
+class CountQueries(object):
+
+    """
+    A context manager that counts the queries executed against the
+    given database alias.
+    """
+
+    def __init__(self, using=DEFAULT_DB_ALIAS):
+        """Initializes the CountQueries context manager."""
+        self.connection = connections[using]
+        self.count = None
+
+    def __enter__(self):
+        if hasattr(self.connection, "force_debug_cursor"):
+            self._debug_cursor_attribute = "force_debug_cursor"
+        else:  # Django < 1.8
+            self._debug_cursor_attribute = "use_debug_cursor"
+        self._use_debug_cursor = getattr(self.connection, self._debug_cursor_attribute)
+        setattr(self.connection, self._debug_cursor_attribute, True)
+        # Stop test client requests from resetting the query log.
+        request_started.disconnect(reset_queries)
+        self._initial_queries = len(self.connection.queries)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.count = len(self.connection.queries) - self._initial_queries
+        setattr(self.connection, self._debug_cursor_attribute, self._use_debug_cursor)
+        request_started.connect(reset_queries)
+
+
+class _AssertMaxQueriesContext(CountQueries):
+
+    def __init__(self, test_case, budget, using):
+        super(_AssertMaxQueriesContext, self).__init__(using)
+        self.test_case = test_case
+        self.budget = budget
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        super(_AssertMaxQueriesContext, self).__exit__(exc_type, exc_value, traceback)
+        if exc_type is None:
+            self.test_case.assertLessEqual(
+                self.count,
+                self.budget,
+                "%i queries executed, but the budget is %i" % (self.count, self.budget),
+            )
+
+
+class QueryBudgetTestMixin(object):
+
+    """
+    Query budget assertions for a TestCase.
+    """
+
+    def assertMaxQueries(self, budget, func=None, *args, **kwargs):
+        """
+        Asserts that no more than `budget` queries are executed.
+
+        Can be called with a function and its arguments, or used as a
+        context manager.
+        """
+        using = kwargs.pop("using", DEFAULT_DB_ALIAS)
+        context = _AssertMaxQueriesContext(self, budget, using)
+        if func is None:
+            return context
+        with context:
+            return func(*args, **kwargs)
+
+    def assertConstantQueries(self, func, args_list, budget=None, using=DEFAULT_DB_ALIAS):
+        """
+        Asserts that calling `func` with each argument in `args_list`
+        executes the same number of queries, and, if given, no more
+        than `budget` queries.
+
+        Returns the number of queries executed by each call.
+        """
+        counts = []
+        for args in args_list:
+            with CountQueries(using) as count_queries:
+                func(args)
+            counts.append(count_queries.count)
+        self.assertEqual(
+            len(set(counts)),
+            1,
+            "Query counts vary with the arguments: %r" % (counts,),
+        )
+        if budget is not None:
+            self.assertLessEqual(
+                counts[0],
+                budget,
+                "%i queries executed, but the budget is %i" % (counts[0], budget),
+            )
+        return counts[0]
@@ -1,10 +1,18 @@
-import time, unittest
+import json, os, shutil, tempfile, time, unittest
+from datetime import date
 
 from django.db import models
 from django.test import TestCase
+from django.test.utils import override_settings
 from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core import signing
+from django.core.management import call_command
+from django.utils.crypto import get_random_string
 
-from access_tokens import tokens, scope
+from access_tokens import tokens, scope, payload, references, keys, registry, snapshot, nonces, audit
+from access_tokens.models import ConsumedNonce, TokenUsage
+from access_tokens.testing import CountQueries, QueryBudgetTestMixin
 
 
 # Define some test models.
@@ -47,11 +55,28 @@ kitchen_sink_scope_serializer = type("KitchenSinkScopeSerializer", (
 ), {})()
 kitchen_sink_token_generator = tokens.TokenGenerator(kitchen_sink_scope_serializer)
 
+basic_compact_token_generator = tokens.TokenGenerator(basic_scope_serializer, payload_serializer=payload.CompactPayloadSerializer)
+
+kitchen_sink_compact_token_generator = tokens.TokenGenerator(kitchen_sink_scope_serializer, payload_serializer=payload.CompactPayloadSerializer)
+
+reference_token_generator = tokens.TokenGenerator(kitchen_sink_scope_serializer, reference_store=references.CacheReferenceStore(), reference_timeout=60 * 60)
+
+all_token_generators = (
+    default_token_generator,
+    basic_token_generator,
+    content_type_token_generator,
+    auth_permission_token_generator,
+    kitchen_sink_token_generator,
+    basic_compact_token_generator,
+    kitchen_sink_compact_token_generator,
+    reference_token_generator,
+)
+
 
 # Test all possible combinations of token generators.
 
 
-class TestAccessTokens(TestCase):
+class TestAccessTokens(QueryBudgetTestMixin, TestCase):
 
     token_generator = default_token_generator
 
@@ -62,14 +87,14 @@ class TestAccessTokens(TestCase):
     # Token compatibility tests.
 
     def testMismatchedTokenFormatDoesNotError(self):
-        for token_generator in (default_token_generator, basic_token_generator, content_type_token_generator, auth_permission_token_generator, kitchen_sink_token_generator):
+        for token_generator in all_token_generators:
             self.assertEqual(
                 self.token_generator.validate(token_generator.generate(scope.access_all("read")), scope.access_all("read")),
-                token_generator._scope_serializer.get_scope_protocol_version() == self.token_generator._scope_serializer.get_scope_protocol_version(),
+                token_generator._get_salt() == self.token_generator._get_salt(),
             )
             self.assertEqual(
                 token_generator.validate(self.token_generator.generate(scope.access_all("read")), scope.access_all("read")),
-                token_generator._scope_serializer.get_scope_protocol_version() == self.token_generator._scope_serializer.get_scope_protocol_version(),
+                token_generator._get_salt() == self.token_generator._get_salt(),
             )
 
     # Invalid token tests.
@@ -85,11 +110,107 @@ class TestAccessTokens(TestCase):
         valid_token = self.token_generator.generate(scope.access_all())
         self.assertFalse(self.token_generator.validate(valid_token, scope.access_all(), key="bad_key"))
 
+    def testIncorrectTenantGrantsNothing(self):
+        valid_token = self.token_generator.generate(scope.access_all("read"), tenant="tenant_1")
+        self.assertTrue(self.token_generator.validate(valid_token, scope.access_all("read"), tenant="tenant_1"))
+        self.assertFalse(self.token_generator.validate(valid_token, scope.access_all("read"), tenant="tenant_2"))
+        self.assertFalse(self.token_generator.validate(valid_token, scope.access_all("read")))
+
+    def testTenantKeyIsDerivedFromKey(self):
+        valid_token = self.token_generator.generate(scope.access_all("read"), key="key_1", tenant="tenant_1")
+        self.assertTrue(self.token_generator.validate(valid_token, scope.access_all("read"), key="key_1", tenant="tenant_1"))
+        self.assertFalse(self.token_generator.validate(valid_token, scope.access_all("read"), key="key_2", tenant="tenant_1"))
+        self.assertFalse(self.token_generator.validate(valid_token, scope.access_all("read"), tenant="tenant_1"))
+
     def testExpiredAccessTokenGrantsNothing(self):
         valid_token = self.token_generator.generate(scope.access_all())
         time.sleep(0.1)
         self.assertFalse(self.token_generator.validate(valid_token, scope.access_all(), max_age=0.05))
 
+    # Attenuated token tests.
+
+    def testAttenuatedTokenGrantsCaveatScope(self):
+        token = self.token_generator.generate(scope.access_all("read", "write"))
+        attenuated_token = self.token_generator.attenuate(token, scope.access_obj(self.obj, "read"))
+        self.assertTrue(self.token_generator.validate(attenuated_token, scope.access_obj(self.obj, "read")))
+        self.assertFalse(self.token_generator.validate(attenuated_token, scope.access_obj(self.obj, "write")))
+        self.assertFalse(self.token_generator.validate(attenuated_token, scope.access_obj(self.obj2, "read")))
+
+    def testAttenuatedTokenCannotWidenScope(self):
+        token = self.token_generator.generate(scope.access_obj(self.obj, "read"))
+        attenuated_token = self.token_generator.attenuate(token, scope.access_all("read", "write"))
+        self.assertTrue(self.token_generator.validate(attenuated_token, scope.access_obj(self.obj, "read")))
+        self.assertFalse(self.token_generator.validate(attenuated_token, scope.access_obj(self.obj, "write")))
+
+    def testAttenuatedTokenCanBeAttenuatedAgain(self):
+        token = self.token_generator.generate(scope.access_all("read", "write"))
+        attenuated_token = self.token_generator.attenuate(token, scope.access_all("read"))
+        attenuated_token = self.token_generator.attenuate(attenuated_token, scope.access_obj(self.obj, "read", "write"))
+        self.assertTrue(self.token_generator.validate(attenuated_token, scope.access_obj(self.obj, "read")))
+        self.assertFalse(self.token_generator.validate(attenuated_token, scope.access_obj(self.obj, "write")))
+
+    def testAttenuatedTokenCaveatsCannotBeRemoved(self):
+        token = self.token_generator.generate(scope.access_all("read", "write"))
+        attenuated_token = self.token_generator.attenuate(token, scope.access_all("read"))
+        attenuated_token = self.token_generator.attenuate(attenuated_token, scope.access_all("read"))
+        token_parts = attenuated_token.split(tokens.ATTENUATION_SEPARATOR)
+        for stripped_token in (
+            tokens.ATTENUATION_SEPARATOR.join(token_parts[:1] + token_parts[2:]),
+            tokens.ATTENUATION_SEPARATOR.join(token_parts[:2] + token_parts[3:]),
+            tokens.ATTENUATION_SEPARATOR.join(token_parts[:1] + token_parts[3:]),
+        ):
+            self.assertFalse(self.token_generator.validate(stripped_token, scope.access_all("write")))
+
+    def testAttenuatedTokenExpires(self):
+        token = self.token_generator.generate(scope.access_all("read"))
+        self.assertTrue(self.token_generator.validate(self.token_generator.attenuate(token, max_age=60), scope.access_all("read")))
+        attenuated_token = self.token_generator.attenuate(token, max_age=0.05)
+        time.sleep(0.1)
+        self.assertFalse(self.token_generator.validate(attenuated_token, scope.access_all("read")))
+
+    def testAttenuatedTokenKeepsOriginalExpiry(self):
+        token = self.token_generator.generate(scope.access_all("read"))
+        attenuated_token = self.token_generator.attenuate(token, max_age=60)
+        time.sleep(0.1)
+        self.assertFalse(self.token_generator.validate(attenuated_token, scope.access_all("read"), max_age=0.05))
+
+    def testAttenuatedTokenRequiresKey(self):
+        token = self.token_generator.generate(scope.access_all("read"), key="key_1")
+        attenuated_token = self.token_generator.attenuate(token, scope.access_all("read"))
+        self.assertTrue(self.token_generator.validate(attenuated_token, scope.access_all("read"), key="key_1"))
+        self.assertFalse(self.token_generator.validate(attenuated_token, scope.access_all("read"), key="key_2"))
+
+    def testAttenuatedInvalidTokenGrantsNothing(self):
+        self.assertFalse(self.token_generator.validate(self.token_generator.attenuate("bad:token"), scope.access_all()))
+        self.assertFalse(self.token_generator.validate("bad~token", scope.access_all()))
+
+    def testAttenuatedTokenWithMalformedCaveatGrantsNothing(self):
+        token = self.token_generator.generate(scope.access_all("read"))
+        value, signature = token.rsplit(":", 1)
+        for caveat in ("not_a_caveat", "WzFd"):
+            malformed_token = tokens.ATTENUATION_SEPARATOR.join((value, caveat, tokens._chain_signature(signature, caveat)))
+            self.assertFalse(self.token_generator.validate(malformed_token, scope.access_all("read")))
+
+    def testAttenuatedTokenWithCraftedCaveatGrantsNothing(self):
+        token = self.token_generator.generate(scope.access_all("read"))
+        value, signature = token.rsplit(":", 1)
+        for caveat in (
+            [5, None],
+            [[[1]], None],
+            [[1], None],
+            [[[[99999], ["read"]]], None],
+            [[[[99999, 1], [99999]]], None],
+            [None, "x"],
+            [None, True],
+            [None, [1]],
+            [None, None, None],
+            {"s": None},
+            5,
+        ):
+            caveat = signing.b64_encode(self.token_generator._payload_serializer().dumps(caveat)).decode("ascii")
+            crafted_token = tokens.ATTENUATION_SEPARATOR.join((value, caveat, tokens._chain_signature(signature, caveat)))
+            self.assertFalse(self.token_generator.validate(crafted_token, scope.access_obj(self.obj, "read")))
+
     # Valid token tests.
 
     def assertScope(self, scope, parent_scope, expected):
@@ -271,6 +392,108 @@ class TestAccessTokens(TestCase):
             (),
         )
 
+    def testScopeWildcardPermissionGrants(self):
+        # App-wide wildcards.
+        self.assertScopeValid(
+            scope.access_obj(self.obj, "access_tokens.change_testmodel"),
+            scope.access_all("access_tokens.*"),
+        )
+        self.assertScopeInvalid(
+            scope.access_obj(self.obj, "auth.change_permission"),
+            scope.access_all("access_tokens.*"),
+        )
+        # Wildcards in several places.
+        self.assertScopeValid(
+            scope.access_model(TestModel, "auth.view_user", "access_tokens.view_testmodel"),
+            scope.access_all("*.view_*"),
+        )
+        self.assertScopeInvalid(
+            scope.access_model(TestModel, "auth.change_user"),
+            scope.access_all("*.view_*"),
+        )
+        # A bare wildcard grants everything.
+        self.assertScopeValid(
+            scope.access_obj(self.obj, "read", "auth.change_permission"),
+            scope.access_all("*"),
+        )
+        # Wildcards are still bound to their model grant.
+        self.assertScopeInvalid(
+            scope.access_obj(self.obj2, "access_tokens.change_testmodel2"),
+            scope.access_model(TestModel, "access_tokens.*"),
+        )
+        # Wildcards combine with explicit permissions.
+        self.assertScopeValid(
+            scope.access_obj(self.obj, "read", "auth.change_permission"),
+            scope.access_all("read") + scope.access_model(TestModel, "auth.*"),
+        )
+
+    def testScopeKnownPermissionGrants(self):
+        self.assertScopeValid(
+            scope.access_all("auth.change_permission"),
+            scope.access_all("auth.change_permission"),
+        )
+        self.assertScopeInvalid(
+            scope.access_all("auth.change_permission"),
+            scope.access_all("auth.add_permission"),
+        )
+
+    def testScopeObjsGrants(self):
+        objs = [TestModel.objects.create() for _ in range(5)]
+        objs_scope = scope.access_objs(TestModel.objects.filter(pk__in=[obj.pk for obj in objs[:4]]), "read")
+        # Ask for access to objs in the set.
+        for obj in objs[:4]:
+            self.assertScopeValid(
+                scope.access_obj(obj, "read"),
+                objs_scope,
+            )
+        self.assertScopeValid(
+            scope.access_objs(TestModel.objects.filter(pk__in=[objs[1].pk, objs[3].pk]), "read"),
+            objs_scope,
+        )
+        # Ask for access to objs outside the set.
+        self.assertScopeInvalid(
+            scope.access_obj(objs[4], "read"),
+            objs_scope,
+        )
+        self.assertScopeInvalid(
+            scope.access_objs(TestModel, "read"),
+            objs_scope,
+        )
+        self.assertScopeInvalid(
+            scope.access_obj(self.obj2, "read"),
+            objs_scope,
+        )
+        # Ask for the wrong permissions, or a whole model.
+        self.assertScopeInvalid(
+            scope.access_obj(objs[0], "write"),
+            objs_scope,
+        )
+        self.assertScopeInvalid(
+            scope.access_model(TestModel, "read"),
+            objs_scope,
+        )
+        # Ask for a set of objs from broader grants.
+        self.assertScopeValid(
+            scope.access_objs(TestModel, "read"),
+            scope.access_model(TestModel, "read"),
+        )
+        self.assertScopeValid(
+            scope.access_objs(TestModel.objects.filter(pk=objs[0].pk), "read"),
+            scope.access_obj(objs[0], "read"),
+        )
+        self.assertScopeInvalid(
+            scope.access_objs(TestModel.objects.filter(pk__in=[objs[0].pk, objs[1].pk]), "read"),
+            scope.access_obj(objs[0], "read"),
+        )
+
+    def testScopeObjsTokenSizeDoesNotDependOnContiguousObjs(self):
+        def get_objs_scope(pks):
+            return ((("access_tokens", "testmodel", scope.PkSet.from_pks(pks)), ("read",)),)
+        token = self.token_generator.generate(get_objs_scope(range(1000, 6000)))
+        self.assertEqual(len(token), len(self.token_generator.generate(get_objs_scope(range(1000, 1002)))))
+        self.assertTrue(self.token_generator.validate(token, get_objs_scope([2500])))
+        self.assertFalse(self.token_generator.validate(token, get_objs_scope([6000])))
+
     def testKitchenSink(self):
         # Access specific models using a global read token.
         self.assertScopeValid(
@@ -303,6 +526,554 @@ class TestAccessTokens(TestCase):
             scope.access_model(self.obj, "write") + scope.access_all("read"),
         )
 
+    # Query budget tests.
+
+    query_budget_sizes = (1, 10, 100)
+
+    cold_query_budget = 2  # One content types table and one permissions table.
+
+    def getQueryBudgetScope(self, size, offset=0):
+        return sum(
+            (
+                scope.access_obj(TestModel(pk=pk), "read", "auth.change_permission")
+                for pk
+                in range(offset + 1, offset + size + 1)
+            ),
+            scope.access_model(TestModel2, "auth.add_permission"),
+        )
+
+    def clearLookupCaches(self):
+        scope_serializer = self.token_generator._scope_serializer
+        if hasattr(scope_serializer, "clear_content_type_cache"):
+            scope_serializer.clear_content_type_cache()
+        if hasattr(scope_serializer, "clear_permission_cache"):
+            scope_serializer.clear_permission_cache()
+        self.token_generator._reference_cache.clear()
+
+    def generateQueryBudgetToken(self, size):
+        return self.token_generator.generate(self.getQueryBudgetScope(size))
+
+    def validateQueryBudgetToken(self, size):
+        self.assertTrue(self.token_generator.validate(self.budget_tokens[size], self.getQueryBudgetScope(size)))
+
+    def validateColdQueryBudgetToken(self, size):
+        self.clearLookupCaches()
+        self.validateQueryBudgetToken(size)
+
+    def validateQueryBudgetTokens(self, count):
+        budget_tokens = self.budget_token_batches[count]
+        self.token_generator.prefetch(budget_tokens)
+        for offset, token in enumerate(budget_tokens):
+            self.assertTrue(self.token_generator.validate(token, self.getQueryBudgetScope(1, offset)))
+
+    def validateColdQueryBudgetTokens(self, count):
+        self.clearLookupCaches()
+        self.validateQueryBudgetTokens(count)
+
+    def testGenerateQueryBudget(self):
+        self.generateQueryBudgetToken(1)
+        self.assertConstantQueries(self.generateQueryBudgetToken, self.query_budget_sizes, budget=0)
+
+    def testGenerateColdQueryBudget(self):
+        def generate_cold(size):
+            self.clearLookupCaches()
+            self.generateQueryBudgetToken(size)
+        self.assertConstantQueries(generate_cold, self.query_budget_sizes, budget=self.cold_query_budget)
+
+    def testValidateQueryBudget(self):
+        self.budget_tokens = dict(
+            (size, self.generateQueryBudgetToken(size))
+            for size
+            in self.query_budget_sizes
+        )
+        self.validateQueryBudgetToken(1)
+        self.assertConstantQueries(self.validateQueryBudgetToken, self.query_budget_sizes, budget=0)
+        self.assertConstantQueries(self.validateColdQueryBudgetToken, self.query_budget_sizes, budget=self.cold_query_budget)
+
+    def testBulkValidateQueryBudget(self):
+        self.budget_token_batches = dict(
+            (
+                count,
+                [
+                    self.token_generator.generate(self.getQueryBudgetScope(1, offset))
+                    for offset
+                    in range(count)
+                ],
+            )
+            for count
+            in self.query_budget_sizes
+        )
+        self.validateQueryBudgetTokens(1)
+        self.assertConstantQueries(self.validateQueryBudgetTokens, self.query_budget_sizes, budget=0)
+        self.assertConstantQueries(self.validateColdQueryBudgetTokens, self.query_budget_sizes, budget=self.cold_query_budget)
+
+
+class TestQueryBudgetTestMixin(QueryBudgetTestMixin, TestCase):
+
+    def testAssertMaxQueries(self):
+        with self.assertMaxQueries(1):
+            TestModel.objects.count()
+        self.assertEqual(self.assertMaxQueries(2, TestModel.objects.count), 0)
+        with self.assertRaises(AssertionError):
+            with self.assertMaxQueries(1):
+                TestModel.objects.count()
+                TestModel.objects.count()
+
+    def testAssertConstantQueries(self):
+        self.assertEqual(self.assertConstantQueries(lambda n: TestModel.objects.count(), (1, 2)), 1)
+        with self.assertRaises(AssertionError):
+            self.assertConstantQueries(lambda n: [TestModel.objects.count() for _ in range(n)], (1, 2))
+        with self.assertRaises(AssertionError):
+            self.assertConstantQueries(lambda n: TestModel.objects.count(), (1, 2), budget=0)
+
+    def testCountQueriesRestoresDebugCursor(self):
+        from django.db import connection
+        debug_cursor_attribute = "force_debug_cursor" if hasattr(connection, "force_debug_cursor") else "use_debug_cursor"
+        use_debug_cursor = getattr(connection, debug_cursor_attribute)
+        with CountQueries() as count_queries:
+            self.assertTrue(getattr(connection, debug_cursor_attribute))
+            TestModel.objects.count()
+        self.assertEqual(count_queries.count, 1)
+        self.assertEqual(getattr(connection, debug_cursor_attribute), use_debug_cursor)
+
+
+class CountingScopeSerializer(scope.ScopeSerializer):
+
+    def __init__(self):
+        super(CountingScopeSerializer, self).__init__()
+        self.model_grant_count = 0
+        self.permission_grant_count = 0
+
+    def deserialize_model_grant(self, serialized_model_grant):
+        self.model_grant_count += 1
+        return super(CountingScopeSerializer, self).deserialize_model_grant(serialized_model_grant)
+
+    def deserialize_permission_grant(self, serialized_permission_grant):
+        self.permission_grant_count += 1
+        return super(CountingScopeSerializer, self).deserialize_permission_grant(serialized_permission_grant)
+
+
+class TestLazyScopeDeserialization(TestCase):
+
+    def setUp(self):
+        self.scope_serializer = CountingScopeSerializer()
+        self.token_generator = tokens.TokenGenerator(self.scope_serializer)
+        self.token = self.token_generator.generate(sum(
+            (
+                scope.access_obj(TestModel(pk=pk), "read", "write", "publish")
+                for pk
+                in range(1, 101)
+            ),
+            (),
+        ))
+
+    def testValidationStopsOnceScopeIsGranted(self):
+        self.assertTrue(self.token_generator.validate(self.token, scope.access_obj(TestModel(pk=1), "read")))
+        self.assertEqual(self.scope_serializer.model_grant_count, 1)
+        self.assertEqual(self.scope_serializer.permission_grant_count, 3)
+
+    def testValidationSkipsPermissionsOfUnmatchedGrants(self):
+        self.assertTrue(self.token_generator.validate(self.token, scope.access_obj(TestModel(pk=50), "read") + scope.access_obj(TestModel(pk=10), "write")))
+        self.assertEqual(self.scope_serializer.model_grant_count, 50)
+        self.assertEqual(self.scope_serializer.permission_grant_count, 6)
+
+    def testDeniedValidationSkipsPermissionsOfUnmatchedGrants(self):
+        self.assertFalse(self.token_generator.validate(self.token, scope.access_obj(TestModel(pk=10), "delete")))
+        self.assertEqual(self.scope_serializer.model_grant_count, 100)
+        self.assertEqual(self.scope_serializer.permission_grant_count, 3)
+
+    def testDeserializeScopeIsEager(self):
+        serialized_scope = self.scope_serializer.serialize_scope(scope.access_obj(TestModel(pk=1), "read", "write"))
+        self.assertEqual(
+            self.scope_serializer.deserialize_scope(serialized_scope),
+            [(("access_tokens", "testmodel", 1), ["read", "write"])],
+        )
+
+
+class TestGenerationCache(TestCase):
+
+    def setUp(self):
+        self.obj = TestModel.objects.create()
+        self.token_generator = tokens.TokenGenerator(
+            kitchen_sink_scope_serializer,
+            reference_store = references.CacheReferenceStore(),
+            reference_timeout = 60 * 60,
+            generation_cache_size = 10,
+            generation_cache_bucket = 60 * 60,
+        )
+
+    def testGenerationCacheIsDisabledByDefault(self):
+        self.assertIsNone(basic_token_generator.generation_cache_info())
+
+    def testGenerationCacheReusesTokens(self):
+        token = self.token_generator.generate(scope.access_obj(self.obj, "read"))
+        self.assertEqual(self.token_generator.generate(scope.access_obj(self.obj, "read")), token)
+        self.assertTrue(self.token_generator.validate(token, scope.access_obj(self.obj, "read")))
+        generation_cache_info = self.token_generator.generation_cache_info()
+        self.assertEqual(generation_cache_info.hits, 1)
+        self.assertEqual(generation_cache_info.misses, 1)
+
+    def testGenerationCacheIgnoresGrantOrder(self):
+        obj_2 = TestModel.objects.create()
+        token = self.token_generator.generate(scope.access_obj(self.obj, "read", "write") + scope.access_obj(obj_2, "read"))
+        self.assertEqual(self.token_generator.generate(scope.access_obj(obj_2, "read") + scope.access_obj(self.obj, "write", "read")), token)
+        self.assertEqual(self.token_generator.generation_cache_info().hits, 1)
+
+    def testGenerationCacheIsKeyedByArguments(self):
+        token = self.token_generator.generate(scope.access_obj(self.obj, "read"))
+        self.assertNotEqual(self.token_generator.generate(scope.access_obj(self.obj, "write")), token)
+        self.assertNotEqual(self.token_generator.generate(scope.access_obj(self.obj, "read"), key="other_key"), token)
+        self.assertNotEqual(self.token_generator.generate(scope.access_obj(self.obj, "read"), salt="other_salt"), token)
+        self.assertNotEqual(self.token_generator.generate(scope.access_obj(self.obj, "read"), tenant="other_tenant"), token)
+        self.assertEqual(self.token_generator.generation_cache_info().hits, 0)
+
+    def testGenerationCacheExpiresWithTimeBucket(self):
+        token_generator = tokens.TokenGenerator(
+            kitchen_sink_scope_serializer,
+            reference_store = references.CacheReferenceStore(),
+            reference_timeout = 60 * 60,
+            generation_cache_size = 10,
+            generation_cache_bucket = 0.05,
+        )
+        token = token_generator.generate(scope.access_obj(self.obj, "read"))
+        time.sleep(0.1)
+        self.assertNotEqual(token_generator.generate(scope.access_obj(self.obj, "read")), token)
+
+    def testReusedTokensKeepTheirTimestamp(self):
+        token = self.token_generator.generate(scope.access_obj(self.obj, "read"))
+        time.sleep(0.1)
+        self.assertEqual(self.token_generator.generate(scope.access_obj(self.obj, "read")), token)
+        self.assertFalse(self.token_generator.validate(token, scope.access_obj(self.obj, "read"), max_age=0.05))
+
+    def testGenerationCacheIsBounded(self):
+        for pk in range(100):
+            self.token_generator.generate(scope.access_obj(TestModel(pk=pk), "read"))
+        self.assertEqual(self.token_generator.generation_cache_info().currsize, 10)
+
+
+class TestPermissionIndex(unittest.TestCase):
+
+    def testPermissionIndexMatchesWildcards(self):
+        permission_index = scope._PermissionIndex(["read", "blog.*", "*.view_*", "news.**_post", "a*b*c"])
+        for permission in ("read", "blog.", "blog.change_post", "blog.*", "auth.view_user", "news.change_post", "news._post", "abc", "axxbyyc"):
+            self.assertIn(permission, permission_index)
+        for permission in ("write", "blo", "auth.change_user", "news.change_posts", "ab", "axxbyy", 1):
+            self.assertNotIn(permission, permission_index)
+
+    def testCompiledPermissionIndexesAreReused(self):
+        self.assertIs(
+            scope._compile_permissions_grant(("read", "blog.*")),
+            scope._compile_permissions_grant(["blog.*", "read"]),
+        )
+
+
+class TestPkSet(unittest.TestCase):
+
+    def testPkSetCompressesContiguousPks(self):
+        self.assertEqual(scope.PkSet.from_pks([7, 1, 2, 3, 5, 9, 8, 3]), ((1, 3), 5, (7, 9)))
+        self.assertEqual(scope.PkSet.from_pks(["b", "a", "c"]), ("a", "b", "c"))
+        self.assertEqual(scope.PkSet.from_pks([]), ())
+
+    def testPkSetMembership(self):
+        pk_set = scope.PkSet.from_pks([1, 2, 3, 5, 7, 8, 9])
+        self.assertEqual([pk for pk in range(11) if pk in pk_set], [1, 2, 3, 5, 7, 8, 9])
+
+    def testPkSetIsSubset(self):
+        pk_set = scope.PkSet.from_pks([1, 2, 3, 5, 7, 8, 9])
+        self.assertTrue(scope.PkSet.from_pks([2, 3, 5, 8]).issubset(pk_set))
+        self.assertTrue(scope.PkSet().issubset(pk_set))
+        self.assertFalse(scope.PkSet.from_pks([3, 4]).issubset(pk_set))
+        self.assertFalse(scope.PkSet.from_pks([5, 6, 7]).issubset(pk_set))
+
+    def testPkSetRoundTripsThroughSerializedForm(self):
+        pk_set = scope.PkSet.from_pks([1, 2, 3, 5])
+        self.assertEqual(scope.PkSet([[1, 3], 5]), pk_set)
+        self.assertTrue(3 in scope.PkSet([[1, 3], 5]))
+
+
+class TestTenantKeys(unittest.TestCase):
+
+    def testTenantKeysAreIndependent(self):
+        self.assertNotEqual(keys.derive_tenant_key("key", "tenant_1"), keys.derive_tenant_key("key", "tenant_2"))
+        self.assertNotEqual(keys.derive_tenant_key("key_1", "tenant"), keys.derive_tenant_key("key_2", "tenant"))
+        self.assertEqual(keys.derive_tenant_key("key", "tenant"), keys.derive_tenant_key("key", "tenant"))
+
+    def testTenantKeyCacheIsBounded(self):
+        token_generator = tokens.TokenGenerator(basic_scope_serializer, tenant_key_cache_size=10)
+        for tenant in range(100):
+            token_generator.generate(scope.access_all("read"), tenant=tenant)
+        self.assertEqual(token_generator._tenant_key_cache.info().currsize, 10)
+        token_generator.generate(scope.access_all("read"), tenant=99)
+        self.assertEqual(token_generator._tenant_key_cache.info().hits, 1)
+
+
+class TestSingleUseTokens(TestCase):
+
+    def setUp(self):
+        self.obj = TestModel.objects.create()
+        self.token_generator = tokens.TokenGenerator(kitchen_sink_scope_serializer, nonce_store=nonces.MemoryNonceStore())
+
+    def testSingleUseTokenCanBeConsumedOnce(self):
+        token = self.token_generator.generate(scope.access_obj(self.obj, "read"), single_use=True)
+        self.assertTrue(self.token_generator.validate(token, scope.access_obj(self.obj, "read")))
+        self.assertTrue(self.token_generator.consume(token, scope.access_obj(self.obj, "read")))
+        self.assertFalse(self.token_generator.consume(token, scope.access_obj(self.obj, "read")))
+        self.assertFalse(self.token_generator.validate(token, scope.access_obj(self.obj, "read")))
+
+    def testSingleUseTokensAreUnique(self):
+        token = self.token_generator.generate(scope.access_obj(self.obj, "read"), single_use=True)
+        self.assertNotEqual(self.token_generator.generate(scope.access_obj(self.obj, "read"), single_use=True), token)
+
+    def testDeniedSingleUseTokenIsNotConsumed(self):
+        token = self.token_generator.generate(scope.access_obj(self.obj, "read"), single_use=True)
+        self.assertFalse(self.token_generator.consume(token, scope.access_obj(self.obj, "write")))
+        self.assertTrue(self.token_generator.consume(token, scope.access_obj(self.obj, "read")))
+
+    def testReusableTokensCannotBeConsumed(self):
+        token = self.token_generator.generate(scope.access_obj(self.obj, "read"))
+        self.assertFalse(self.token_generator.consume(token, scope.access_obj(self.obj, "read")))
+        self.assertTrue(self.token_generator.validate(token, scope.access_obj(self.obj, "read")))
+
+    def testSingleUseTokensRequireNonceStore(self):
+        self.assertRaises(ImproperlyConfigured, basic_token_generator.generate, scope.access_all("read"), single_use=True)
+
+    def testSingleUseTokensAreNotMemoized(self):
+        token_generator = tokens.TokenGenerator(kitchen_sink_scope_serializer, nonce_store=nonces.MemoryNonceStore(), generation_cache_size=10)
+        token = token_generator.generate(scope.access_obj(self.obj, "read"), single_use=True)
+        self.assertNotEqual(token_generator.generate(scope.access_obj(self.obj, "read"), single_use=True), token)
+        self.assertEqual(token_generator.generation_cache_info().currsize, 0)
+
+    def testAttenuatedSingleUseTokenSharesNonce(self):
+        token = self.token_generator.generate(scope.access_all("read"), single_use=True)
+        attenuated_token = self.token_generator.attenuate(token, scope.access_obj(self.obj, "read"))
+        self.assertTrue(self.token_generator.consume(attenuated_token, scope.access_obj(self.obj, "read")))
+        self.assertFalse(self.token_generator.validate(token, scope.access_all("read")))
+
+    def testSingleUseTokenFormats(self):
+        for token_generator in (
+            tokens.TokenGenerator(basic_scope_serializer, payload_serializer=payload.CompactPayloadSerializer, nonce_store=nonces.MemoryNonceStore()),
+            tokens.TokenGenerator(kitchen_sink_scope_serializer, reference_store=references.CacheReferenceStore(), reference_timeout=60 * 60, nonce_store=nonces.MemoryNonceStore()),
+            tokens.TokenGenerator(registry.RegisteredScopeSerializer(), nonce_store=nonces.MemoryNonceStore()),
+        ):
+            token = token_generator.generate(scope.access_obj(self.obj, "read"), single_use=True)
+            self.assertTrue(token_generator.consume(token, scope.access_obj(self.obj, "read")))
+            self.assertFalse(token_generator.consume(token, scope.access_obj(self.obj, "read")))
+
+
+class NonceStoreTestMixin(object):
+
+    def getNonce(self):
+        return get_random_string(tokens.NONCE_LENGTH)
+
+    def testNonceCanBeConsumedOnce(self):
+        nonce = self.getNonce()
+        self.assertFalse(self.nonce_store.is_consumed(nonce))
+        self.assertTrue(self.nonce_store.consume(nonce, 60))
+        self.assertTrue(self.nonce_store.is_consumed(nonce))
+        self.assertFalse(self.nonce_store.consume(nonce, 60))
+        self.assertFalse(self.nonce_store.is_consumed(self.getNonce()))
+
+    def testNoncesWithoutTimeoutAreConsumed(self):
+        nonce = self.getNonce()
+        self.assertTrue(self.nonce_store.consume(nonce))
+        self.assertFalse(self.nonce_store.consume(nonce))
+
+    def testNoncesExpire(self):
+        nonce = self.getNonce()
+        self.assertTrue(self.nonce_store.consume(nonce, 0.05))
+        time.sleep(0.1)
+        self.assertFalse(self.nonce_store.is_consumed(nonce))
+        self.assertTrue(self.nonce_store.consume(nonce, 60))
+        self.assertFalse(self.nonce_store.consume(nonce, 60))
+
+
+class TestMemoryNonceStore(NonceStoreTestMixin, TestCase):
+
+    def setUp(self):
+        self.nonce_store = nonces.MemoryNonceStore(shard_count=4)
+
+    def testNoncesAreShardedByPrefix(self):
+        for _ in range(100):
+            self.nonce_store.consume(self.getNonce(), 60)
+        shard_sizes = [len(shard.nonces) for shard in self.nonce_store._shards]
+        self.assertEqual(sum(shard_sizes), 100)
+        self.assertTrue(all(shard_sizes))
+        self.assertIs(self.nonce_store._get_shard("ab123"), self.nonce_store._get_shard("ab456"))
+
+    def testExpiredNoncesAreForgotten(self):
+        for _ in range(100):
+            self.nonce_store.consume(self.getNonce(), 0.05)
+        time.sleep(0.1)
+        nonce = self.getNonce()
+        self.nonce_store.consume(nonce, 60)
+        self.assertEqual(len(self.nonce_store._get_shard(nonce).nonces), 1)
+
+
+class TestCacheNonceStore(NonceStoreTestMixin, TestCase):
+
+    def setUp(self):
+        self.nonce_store = nonces.CacheNonceStore()
+
+    def testNoncesWithoutTimeoutAreConsumed(self):
+        self.assertRaises(ValueError, self.nonce_store.consume, self.getNonce())
+
+    def testSingleUseTokensRequireMaxAge(self):
+        obj = TestModel.objects.create()
+        token_generator = tokens.TokenGenerator(nonce_store=self.nonce_store)
+        token = token_generator.generate(scope.access_obj(obj, "read"), single_use=True)
+        self.assertRaises(ValueError, token_generator.consume, token, scope.access_obj(obj, "read"))
+        self.assertTrue(token_generator.consume(token, scope.access_obj(obj, "read"), max_age=60))
+        self.assertFalse(token_generator.consume(token, scope.access_obj(obj, "read"), max_age=60))
+
+
+class TestDatabaseNonceStore(NonceStoreTestMixin, TestCase):
+
+    def setUp(self):
+        self.nonce_store = nonces.DatabaseNonceStore(purge_interval=10)
+
+    def testExpiredNoncesArePurged(self):
+        for _ in range(9):
+            self.nonce_store.consume(self.getNonce(), 0.05)
+        time.sleep(0.1)
+        self.assertEqual(ConsumedNonce.objects.count(), 9)
+        self.nonce_store.consume(self.getNonce(), 60)
+        self.assertEqual(ConsumedNonce.objects.count(), 1)
+
+
+class RecordingUsageSink(audit.UsageSink):
+
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.batches = []
+
+    def write(self, records):
+        if self.fail:
+            raise IOError("Sink unavailable")
+        self.batches.append(records)
+
+
+class TestUsageRecorder(TestCase):
+
+    def setUp(self):
+        self.obj = TestModel.objects.create()
+        self.sink = RecordingUsageSink()
+        self.usage_recorder = audit.UsageRecorder(self.sink, buffer_size=10, batch_size=4, flush_interval=None)
+        self.token_generator = tokens.TokenGenerator(
+            basic_scope_serializer,
+            nonce_store = nonces.MemoryNonceStore(),
+            usage_recorder = self.usage_recorder,
+        )
+
+    def testValidationIsRecorded(self):
+        token = self.token_generator.generate(scope.access_obj(self.obj, "read"))
+        self.assertTrue(self.token_generator.validate(token, scope.access_obj(self.obj, "read")))
+        self.assertFalse(self.token_generator.validate(token, scope.access_obj(self.obj, "write")))
+        self.assertEqual(self.sink.batches, [])
+        self.usage_recorder.flush()
+        records = self.sink.batches[0]
+        self.assertEqual([record.granted for record in records], [True, False])
+        self.assertEqual([record.scope for record in records], [
+            [[["access_tokens", "testmodel", self.obj.pk], ["read"]]],
+            [[["access_tokens", "testmodel", self.obj.pk], ["write"]]],
+        ])
+        self.assertEqual(records[0].token_digest, audit.get_token_digest(token))
+        self.assertNotIn(token, records[0].token_digest)
+
+    def testConsumptionIsRecorded(self):
+        token = self.token_generator.generate(scope.access_obj(self.obj, "read"), single_use=True)
+        self.token_generator.consume(token, scope.access_obj(self.obj, "read"))
+        self.token_generator.consume(token, scope.access_obj(self.obj, "read"))
+        self.usage_recorder.flush()
+        self.assertEqual([record.granted for record in self.sink.batches[0]], [True, False])
+
+    def testRecordsAreFlushedInBatches(self):
+        for _ in range(10):
+            self.usage_recorder.record("token", scope.access_all("read"), True)
+        self.usage_recorder.flush()
+        self.assertEqual([len(batch) for batch in self.sink.batches], [4, 4, 2])
+        self.assertEqual(self.usage_recorder.info().pending, 0)
+
+    def testFullBufferDropsRecords(self):
+        for _ in range(15):
+            self.usage_recorder.record("token", scope.access_all("read"), True)
+        usage_recorder_info = self.usage_recorder.info()
+        self.assertEqual(usage_recorder_info.recorded, 10)
+        self.assertEqual(usage_recorder_info.dropped, 5)
+        self.assertEqual(usage_recorder_info.pending, 10)
+        self.usage_recorder.flush()
+        self.usage_recorder.record("token", scope.access_all("read"), True)
+        self.assertEqual(self.usage_recorder.info().pending, 1)
+
+    def testFailedWritesAreCounted(self):
+        usage_recorder = audit.UsageRecorder(RecordingUsageSink(fail=True), flush_interval=None)
+        for _ in range(3):
+            usage_recorder.record("token", scope.access_all("read"), True)
+        usage_recorder.flush()
+        usage_recorder_info = usage_recorder.info()
+        self.assertEqual(usage_recorder_info.failed, 3)
+        self.assertEqual(usage_recorder_info.pending, 0)
+
+    def testModelUsageSink(self):
+        usage_recorder = audit.UsageRecorder(audit.ModelUsageSink(), flush_interval=None)
+        for n in range(5):
+            usage_recorder.record("token_%i" % n, scope.access_obj(self.obj, "read"), n % 2 == 0)
+        with self.assertNumQueries(1):
+            usage_recorder.flush()
+        self.assertEqual(TokenUsage.objects.count(), 5)
+        self.assertEqual(TokenUsage.objects.filter(granted=True).count(), 3)
+        token_usage = TokenUsage.objects.get(token_digest=audit.get_token_digest("token_0"))
+        self.assertEqual(json.loads(token_usage.scope), [[["access_tokens", "testmodel", self.obj.pk], ["read"]]])
+
+    def testCompiledScopesAreRecordedAsPlainData(self):
+        obj_2 = TestModel.objects.create()
+        usage_recorder = audit.UsageRecorder(audit.ModelUsageSink(), flush_interval=None)
+        usage_recorder.record("token_1", test_scope_registry.bind("write_testmodel_pair", self.obj.pk, obj_2.pk), True)
+        usage_recorder.record("token_2", scope.access_objs(TestModel, "read"), True)
+        usage_recorder.flush()
+        self.assertEqual(json.loads(TokenUsage.objects.get(token_digest=audit.get_token_digest("token_1")).scope), [
+            [["access_tokens", "testmodel", self.obj.pk], ["read", "write"]],
+            [["access_tokens", "testmodel2", obj_2.pk], ["read", "write"]],
+            [["access_tokens"], ["publish"]],
+        ])
+        self.assertEqual(json.loads(TokenUsage.objects.get(token_digest=audit.get_token_digest("token_2")).scope), [
+            [["access_tokens", "testmodel", [[self.obj.pk, obj_2.pk]]], ["read"]],
+        ])
+
+    def testUnconvertibleRecordsAreDroppedAlone(self):
+        class UnprintablePk(object):
+            def __str__(self):
+                raise ValueError("Unprintable pk")
+            __unicode__ = __str__
+        usage_recorder = audit.UsageRecorder(audit.ModelUsageSink(), flush_interval=None)
+        for n in range(5):
+            usage_recorder.record("token_%i" % n, scope.access_obj(self.obj, "read"), True)
+        usage_recorder.record("token_date", ((("access_tokens", "testmodel", date(2020, 1, 2)), ("read",)),), True)
+        usage_recorder.record("token_unprintable", ((("access_tokens", "testmodel", UnprintablePk()), ("read",)),), True)
+        usage_recorder.flush()
+        usage_recorder_info = usage_recorder.info()
+        self.assertEqual(usage_recorder_info.recorded, 6)
+        self.assertEqual(usage_recorder_info.failed, 1)
+        self.assertEqual(TokenUsage.objects.count(), 6)
+        token_usage = TokenUsage.objects.get(token_digest=audit.get_token_digest("token_date"))
+        self.assertEqual(json.loads(token_usage.scope), [[["access_tokens", "testmodel", "2020-01-02"], ["read"]]])
+
+    def testFileUsageSink(self):
+        usage_dir = tempfile.mkdtemp()
+        try:
+            usage_path = os.path.join(usage_dir, "usage.log")
+            usage_recorder = audit.UsageRecorder(audit.FileUsageSink(usage_path), flush_interval=0.05)
+            usage_recorder.record("token", scope.access_all("read"), True)
+            usage_recorder.record("token", scope.access_all("write"), False)
+            # Wait for the flusher thread.
+            time.sleep(0.2)
+            with open(usage_path) as usage_file:
+                records = [json.loads(line) for line in usage_file]
+            self.assertEqual([record["granted"] for record in records], [True, False])
+            self.assertEqual(records[0]["scope"], [[[], ["read"]]])
+            self.assertEqual(records[0]["token_digest"], audit.get_token_digest("token"))
+        finally:
+            shutil.rmtree(usage_dir)
+
 
 class TestAccessTokensBasicTokenGenerator(TestAccessTokens):
 
@@ -317,6 +1088,34 @@ class TestAccessTokensContentTypeTokenGenerator(TestAccessTokens):
 
     token_generator = content_type_token_generator
 
+    def testContentTypeTablesReturnInternedTuples(self):
+        scope_serializer = self.token_generator._scope_serializer
+        model_grant = scope.access_model(TestModel)[0][0]
+        serialized_model_grant = scope_serializer.serialize_model_grant(model_grant)
+        self.assertIs(scope_serializer.serialize_model_grant(model_grant), serialized_model_grant)
+        self.assertIs(
+            scope_serializer.deserialize_model_grant(list(serialized_model_grant)),
+            scope_serializer.deserialize_model_grant(list(serialized_model_grant)),
+        )
+        self.assertEqual(scope_serializer.deserialize_model_grant([serialized_model_grant[0], self.obj.pk]), ("access_tokens", "testmodel", self.obj.pk))
+
+    def testContentTypeTablesAreClearedAfterMigrate(self):
+        from access_tokens.scope import post_migrate
+        scope_serializer = self.token_generator._scope_serializer
+        scope_serializer.serialize_model_grant(scope.access_model(TestModel)[0][0])
+        self.assertIsNotNone(scope_serializer._content_type_tables)
+        post_migrate.send(sender=None, app=None, created_models=[], verbosity=0, interactive=False, db="default")
+        self.assertIsNone(scope_serializer._content_type_tables)
+
+    def testContentTypeTablesFallBackToDatabase(self):
+        from django.contrib.contenttypes.models import ContentType
+        scope_serializer = self.token_generator._scope_serializer
+        self.addCleanup(scope_serializer.clear_content_type_cache)
+        scope_serializer.serialize_model_grant(scope.access_model(TestModel)[0][0])
+        content_type = ContentType.objects.create(app_label="access_tokens", model="newmodel", name="new model")
+        self.assertEqual(scope_serializer.serialize_model_grant(("access_tokens", "newmodel")), (content_type.id,))
+        self.assertEqual(scope_serializer.deserialize_model_grant([content_type.id]), ("access_tokens", "newmodel"))
+
     def testContentTypeTokenGeneratorCreatesEquivalentGlobalTokens(self):
         self.assertEqual(
             len(self.token_generator.generate(scope.access_all())),
@@ -356,6 +1155,22 @@ class TestAccessTokensAuthPermissionTokenGenerator(TestAccessTokens):
             len(basic_token_generator.generate(scope.access_all("read"))),
         )
 
+    def testAuthPermissionTokenGeneratorDoesNotLookUpWildcardPermissions(self):
+        with self.assertNumQueries(0):
+            self.token_generator.generate(scope.access_all("auth.*"))
+
+    def testAuthPermissionTokenGeneratorReloadsUnknownPermissionsOnce(self):
+        from django.contrib.auth.models import Permission
+        scope_serializer = self.token_generator._scope_serializer
+        self.addCleanup(scope_serializer.clear_permission_cache)
+        missing_permission_id = Permission.objects.order_by("-id").values_list("id", flat=True)[0] + 1
+        scope_serializer.serialize_permission_grant("auth.change_permission")
+        with self.assertNumQueries(1):
+            self.assertEqual(scope_serializer.deserialize_permission_grant(missing_permission_id), missing_permission_id)
+        with self.assertNumQueries(0):
+            for _ in range(10):
+                self.assertEqual(scope_serializer.deserialize_permission_grant(missing_permission_id), missing_permission_id)
+
     def testContentTypeTokenGeneratorCreatesSmallerKnownPermissionTokens(self):
         self.assertLess(
             len(self.token_generator.generate(scope.access_all("auth.change_permission"))),
@@ -373,4 +1188,373 @@ class TestAccessTokensAuthPermissionTokenGenerator(TestAccessTokens):
 )
 class TestAccessTokensKitchenSinkTokenGenerator(TestAccessTokensContentTypeTokenGenerator, TestAccessTokensAuthPermissionTokenGenerator):
 
-    token_generator = kitchen_sink_token_generator
\ No newline at end of file
+    token_generator = kitchen_sink_token_generator
+
+
+class TestAccessTokensBasicCompactTokenGenerator(TestAccessTokens):
+
+    token_generator = basic_compact_token_generator
+
+    def testCompactTokenGeneratorCreatesSmallerTokens(self):
+        self.assertLess(
+            len(self.token_generator.generate(scope.access_obj(self.obj, "read", "write"))),
+            len(basic_token_generator.generate(scope.access_obj(self.obj, "read", "write"))),
+        )
+
+    def testCompactPayloadSerializerRoundTripsAwkwardValues(self):
+        serializer = payload.CompactPayloadSerializer()
+        for serialized_scope in (
+            [],
+            [[[], []]],
+            [[[""], [""]]],
+            [[["app", "model", 1], ["read", "write"]], [[], ["publish"]]],
+            [[["a,b;c|d", "'quoted'", "%"], [u"\u00e9t\u00e9", "12", "-3", "blog.*"]]],
+            [[[12, -3, 0], [4, 5]]],
+        ):
+            self.assertEqual(serializer.loads(serializer.dumps(serialized_scope)), serialized_scope)
+
+    def testCompactPayloadSerializerFallsBackToJSON(self):
+        serializer = payload.CompactPayloadSerializer()
+        self.assertEqual(serializer.loads(serializer.dumps({"a": [1, None]})), {"a": [1, None]})
+
+
+@unittest.skipUnless(
+    "django.contrib.contenttypes" in settings.INSTALLED_APPS,
+    "django.contrib.contenttypes app not installed",
+)
+@unittest.skipUnless(
+    "django.contrib.auth" in settings.INSTALLED_APPS,
+    "django.contrib.auth app not installed",
+)
+class TestAccessTokensKitchenSinkCompactTokenGenerator(TestAccessTokens):
+
+    token_generator = kitchen_sink_compact_token_generator
+
+
+class RecordingReferenceStore(references.ReferenceStore):
+
+    def __init__(self):
+        self.serialized_scopes = {}
+        self.get_many_calls = []
+
+    def get_many(self, references):
+        references = list(references)
+        self.get_many_calls.append(references)
+        return dict(
+            (reference, self.serialized_scopes[reference])
+            for reference
+            in references
+            if reference in self.serialized_scopes
+        )
+
+    def set(self, reference, serialized_scope, timeout=None):
+        self.serialized_scopes[reference] = serialized_scope
+
+
+class TestAccessTokensReferenceTokenGenerator(TestAccessTokens):
+
+    token_generator = reference_token_generator
+
+    def setUp(self):
+        super(TestAccessTokensReferenceTokenGenerator, self).setUp()
+        self.reference_store = RecordingReferenceStore()
+        self.recording_token_generator = tokens.TokenGenerator(basic_scope_serializer, reference_store=self.reference_store)
+
+    def testReferenceTokenSizeDoesNotDependOnScope(self):
+        large_scope = sum((scope.access_obj(self.obj, "read_%i" % n) for n in range(1000)), ())
+        self.assertEqual(
+            len(self.token_generator.generate(large_scope)),
+            len(self.token_generator.generate(scope.access_all())),
+        )
+        self.assertTrue(self.token_generator.validate(self.token_generator.generate(large_scope), scope.access_obj(self.obj, "read_999")))
+
+    def testReferenceTokensAreResolvedFromLocalCache(self):
+        token = self.recording_token_generator.generate(scope.access_all("read"))
+        self.assertTrue(self.recording_token_generator.validate(token, scope.access_all("read")))
+        self.assertEqual(self.reference_store.get_many_calls, [])
+
+    def testReferenceTokensAreResolvedFromStore(self):
+        token = self.recording_token_generator.generate(scope.access_all("read"))
+        self.recording_token_generator._reference_cache.clear()
+        self.assertTrue(self.recording_token_generator.validate(token, scope.access_all("read")))
+        self.assertEqual(len(self.reference_store.get_many_calls), 1)
+
+    def testUnknownReferenceGrantsNothing(self):
+        token = self.recording_token_generator.generate(scope.access_all("read"))
+        self.recording_token_generator._reference_cache.clear()
+        self.reference_store.serialized_scopes.clear()
+        self.assertFalse(self.recording_token_generator.validate(token, scope.access_all("read")))
+
+    def testPrefetchLoadsReferencesInOneBatch(self):
+        access_tokens = [
+            self.recording_token_generator.generate(scope.access_all("read_%i" % n))
+            for n in range(10)
+        ]
+        self.recording_token_generator._reference_cache.clear()
+        self.recording_token_generator.prefetch(access_tokens + ["bad_token"])
+        self.assertEqual(len(self.reference_store.get_many_calls), 1)
+        self.assertEqual(len(self.reference_store.get_many_calls[0]), 10)
+        for n, token in enumerate(access_tokens):
+            self.assertTrue(self.recording_token_generator.validate(token, scope.access_all("read_%i" % n)))
+        self.assertEqual(len(self.reference_store.get_many_calls), 1)
+
+    def testPrefetchLoadsReferencesOfAttenuatedTokens(self):
+        token = self.recording_token_generator.attenuate(self.recording_token_generator.generate(scope.access_all("read")), max_age=60)
+        self.recording_token_generator._reference_cache.clear()
+        self.recording_token_generator.prefetch([token])
+        self.assertEqual(len(self.reference_store.get_many_calls), 1)
+        self.assertTrue(self.recording_token_generator.validate(token, scope.access_all("read")))
+        self.assertEqual(len(self.reference_store.get_many_calls), 1)
+
+    def setTime(self, now):
+        tokens.time = type("FrozenTime", (object,), {"time": staticmethod(lambda: now)})
+
+    def testReferencesLoadedLateExpireOnTime(self):
+        token_generator = tokens.TokenGenerator(basic_scope_serializer, reference_store=self.reference_store, reference_timeout=60)
+        self.addCleanup(setattr, tokens, "time", time)
+        now = time.time()
+        for load_reference in (lambda token: None, lambda token: token_generator.prefetch([token])):
+            token = token_generator.generate(scope.access_all("read"))
+            token_generator._reference_cache.clear()
+            # Load the reference from the store just before it expires.
+            self.setTime(now + 59)
+            load_reference(token)
+            self.assertTrue(token_generator.validate(token, scope.access_all("read")))
+            # Once the store has expired the reference, the local cache must not outlive it.
+            self.setTime(now + 61)
+            self.reference_store.serialized_scopes.clear()
+            self.assertFalse(token_generator.validate(token, scope.access_all("read")))
+            tokens.time = time
+
+
+class TestCacheTimeouts(unittest.TestCase):
+
+    def testTimeoutsArePassedThrough(self):
+        self.assertEqual(references.get_cache_timeout(60), 60)
+
+    @unittest.skipIf(references.DEFAULT_TIMEOUT is None, "Django < 1.6 caches cannot store values forever")
+    def testNoTimeoutMeansForever(self):
+        self.assertIsNone(references.get_cache_timeout(None))
+
+    @unittest.skipUnless(references.DEFAULT_TIMEOUT is None, "Django >= 1.6 caches can store values forever")
+    def testNoTimeoutIsRejected(self):
+        self.assertRaises(ValueError, references.get_cache_timeout, None)
+
+
+
+test_scope_registry = registry.ScopeRegistry()
+
+test_scope_registry.register(1, "read_testmodel", (
+    (("access_tokens", "testmodel", registry.PK), ("read",)),
+))
+
+test_scope_registry.register(2, "write_testmodel_pair", (
+    (("access_tokens", "testmodel", registry.PK), ("read", "write")),
+    (("access_tokens", "testmodel2", registry.PK), ("read", "write")),
+    (("access_tokens",), ("publish",)),
+))
+
+test_scope_registry.register(3, "read_all", scope.access_all("read"))
+
+registered_scope_serializer = type("RegisteredScopeSerializer", (
+    registry.RegisteredScopeSerializerMixin,
+    scope.ScopeSerializer,
+), {"scope_registry": test_scope_registry})()
+registered_token_generator = tokens.TokenGenerator(registered_scope_serializer)
+
+
+class TestAccessTokensRegisteredTokenGenerator(TestAccessTokens):
+
+    token_generator = registered_token_generator
+
+    def testRegisteredScopeGrants(self):
+        self.assertScopeValid(
+            scope.access_obj(self.obj, "read"),
+            test_scope_registry.bind("read_testmodel", self.obj.pk),
+        )
+        self.assertScopeInvalid(
+            scope.access_obj(self.obj, "write"),
+            test_scope_registry.bind("read_testmodel", self.obj.pk),
+        )
+        self.assertScopeInvalid(
+            scope.access_obj(self.obj, "read"),
+            test_scope_registry.bind("read_testmodel", self.obj.pk + 1),
+        )
+        self.assertScopeValid(
+            scope.access_obj(self.obj, "write") + scope.access_obj(self.obj2, "read") + scope.access_app("access_tokens", "publish"),
+            test_scope_registry.bind("write_testmodel_pair", self.obj.pk, self.obj2.pk),
+        )
+        self.assertScopeValid(
+            scope.access_obj(self.obj2, "read"),
+            test_scope_registry.bind("read_all"),
+        )
+
+    def testRegisteredScopeCreatesSmallerTokens(self):
+        self.assertLess(
+            len(self.token_generator.generate(test_scope_registry.bind("write_testmodel_pair", self.obj.pk, self.obj2.pk))),
+            len(basic_token_generator.generate(test_scope_registry.bind("write_testmodel_pair", self.obj.pk, self.obj2.pk))),
+        )
+
+    def testCombinedRegisteredScopesAreSerializedInFull(self):
+        token = self.token_generator.generate(
+            test_scope_registry.bind("read_testmodel", self.obj.pk) + scope.access_obj(self.obj2, "read"),
+        )
+        self.assertTrue(self.token_generator.validate(token, scope.access_obj(self.obj, "read") + scope.access_obj(self.obj2, "read")))
+
+    def testUnknownRegisteredScopeGrantsNothing(self):
+        token = self.token_generator._dumps([99, self.obj.pk], None, None)
+        self.assertFalse(self.token_generator.validate(token, scope.access_obj(self.obj, "read")))
+
+    def testAttenuatedTokenWithRegisteredScopeCaveat(self):
+        token = self.token_generator.generate(scope.access_all("read", "write"))
+        attenuated_token = self.token_generator.attenuate(token, test_scope_registry.bind("read_testmodel", self.obj.pk))
+        self.assertTrue(self.token_generator.validate(attenuated_token, scope.access_obj(self.obj, "read")))
+        self.assertFalse(self.token_generator.validate(attenuated_token, scope.access_obj(self.obj, "write")))
+
+
+class TestScopeRegistry(unittest.TestCase):
+
+    def testRegisteredTemplatesArePrecompiled(self):
+        template = test_scope_registry.get_template("read_testmodel")
+        self.assertIs(
+            template.bind(1)[0][1],
+            template.bind(2)[0][1],
+        )
+        self.assertIsInstance(template.bind(1)[0][1], scope._PermissionIndex)
+
+    def testBindRequiresOnePkPerPlaceholder(self):
+        self.assertRaises(TypeError, test_scope_registry.bind, "read_testmodel")
+        self.assertRaises(TypeError, test_scope_registry.bind, "read_testmodel", 1, 2)
+
+    def testDuplicateRegistrationFails(self):
+        self.assertRaises(registry.RegistrationError, test_scope_registry.register, 1, "other", ())
+        self.assertRaises(registry.RegistrationError, test_scope_registry.register, 99, "read_testmodel", ())
+
+    @override_settings(ACCESS_TOKENS_SCOPE_TEMPLATES=(
+        (1, "read_testmodel", (
+            (("access_tokens", "testmodel", "<pk>"), ("read",)),
+        )),
+    ))
+    def testTemplatesAreLoadedFromSettings(self):
+        scope_registry = registry.ScopeRegistry()
+        self.assertEqual(
+            list(scope_registry.bind("read_testmodel", 1)[0][0]),
+            ["access_tokens", "testmodel", 1],
+        )
+        self.assertIs(scope_registry.get_template_by_id(1), scope_registry.get_template("read_testmodel"))
+
+
+
+@unittest.skipUnless(
+    "django.contrib.contenttypes" in settings.INSTALLED_APPS,
+    "django.contrib.contenttypes app not installed",
+)
+@unittest.skipUnless(
+    "django.contrib.auth" in settings.INSTALLED_APPS,
+    "django.contrib.auth app not installed",
+)
+class TestCodecSnapshot(QueryBudgetTestMixin, TestCase):
+
+    def setUp(self):
+        self.obj = TestModel.objects.create()
+        self.snapshot_dir = tempfile.mkdtemp()
+        self.snapshot_path = os.path.join(self.snapshot_dir, "codec.snapshot")
+        call_command("access_tokens_snapshot", self.snapshot_path, verbosity=0)
+        snapshot.clear_snapshot_cache()
+
+    def tearDown(self):
+        shutil.rmtree(self.snapshot_dir)
+        snapshot.clear_snapshot_cache()
+
+    def getTokenGenerator(self):
+        scope_serializer = type("KitchenSinkScopeSerializer", (
+            scope.ContentTypeScopeSerializerMixin,
+            scope.AuthPermissionScopeSerializerMixin,
+            scope.ScopeSerializer,
+        ), {})()
+        return tokens.TokenGenerator(scope_serializer)
+
+    def testSnapshotContainsIds(self):
+        from django.contrib.auth.models import Permission
+        from django.contrib.contenttypes.models import ContentType
+        codec_snapshot = snapshot.load_snapshot(self.snapshot_path)
+        content_type = ContentType.objects.get_for_model(TestModel)
+        self.assertEqual(codec_snapshot.content_types[content_type.id], ("access_tokens", "testmodel"))
+        self.assertEqual(codec_snapshot.content_type_ids[("access_tokens", "testmodel")], content_type.id)
+        permission = Permission.objects.get(content_type__app_label="auth", codename="change_permission")
+        self.assertEqual(codec_snapshot.permissions[permission.id], "auth.change_permission")
+
+    def testSnapshotIsReadOnly(self):
+        self.assertEqual(os.stat(self.snapshot_path).st_mode & 0o777, 0o444)
+
+    def testMissingSnapshotIsIgnored(self):
+        self.assertIsNone(snapshot.load_snapshot(os.path.join(self.snapshot_dir, "missing.snapshot")))
+
+    def testStaleSnapshotIsIgnored(self):
+        with open(self.snapshot_path, "rb") as snapshot_file:
+            data = snapshot_file.read()
+        stale_path = os.path.join(self.snapshot_dir, "stale.snapshot")
+        with open(stale_path, "wb") as snapshot_file:
+            snapshot_file.write(data.replace(snapshot.get_schema_fingerprint().encode("ascii"), b"0" * 40))
+        self.assertIsNone(snapshot.load_snapshot(stale_path))
+
+    def testSnapshotAvoidsQueries(self):
+        scope_to_check = scope.access_obj(self.obj, "read", "auth.change_permission")
+        with self.settings(ACCESS_TOKENS_CODEC_SNAPSHOT=self.snapshot_path):
+            token_generator = self.getTokenGenerator()
+            with self.assertMaxQueries(0):
+                token = token_generator.generate(scope_to_check)
+            token_generator = self.getTokenGenerator()
+            with self.assertMaxQueries(0):
+                self.assertTrue(token_generator.validate(token, scope_to_check))
+        self.assertTrue(self.getTokenGenerator().validate(token, scope_to_check))
+
+    def testStaleSnapshotFallsBackToLiveLookups(self):
+        scope_to_check = scope.access_obj(self.obj, "read", "auth.change_permission")
+        live_token_generator = self.getTokenGenerator()
+        live_token = live_token_generator.generate(scope_to_check)
+        live_serialized_scope = live_token_generator._scope_serializer.serialize_scope(scope_to_check)
+        with open(self.snapshot_path, "rb") as snapshot_file:
+            data = snapshot_file.read()
+        path = self.writeSnapshot(data.replace(snapshot.get_schema_fingerprint().encode("ascii"), b"0" * 40))
+        with self.settings(ACCESS_TOKENS_CODEC_SNAPSHOT=path):
+            self.assertIsNone(snapshot.get_snapshot())
+            token_generator = self.getTokenGenerator()
+            self.assertTrue(token_generator.validate(live_token, scope_to_check))
+            self.assertEqual(token_generator._scope_serializer.serialize_scope(scope_to_check), live_serialized_scope)
+
+    def writeSnapshot(self, data):
+        path = os.path.join(self.snapshot_dir, "broken.snapshot")
+        with open(path, "wb") as snapshot_file:
+            snapshot_file.write(data)
+        return path
+
+    def testMalformedSnapshotIsIgnored(self):
+        with open(self.snapshot_path, "rb") as snapshot_file:
+            header = snapshot_file.readline()
+        self.assertIsNone(snapshot.load_snapshot(self.writeSnapshot(b"")))
+        self.assertIsNone(snapshot.load_snapshot(self.writeSnapshot(header + b"c\t1\n")))
+        self.assertIsNone(snapshot.load_snapshot(self.writeSnapshot(header + b"c\tx\tauth\tuser\n")))
+        self.assertIsNone(snapshot.load_snapshot(self.writeSnapshot(header + b"q\t1\tauth\tuser\n")))
+        self.assertIsNone(snapshot.load_snapshot(self.writeSnapshot(b"\xff\xfe")))
+
+    def testUnusableSnapshotFallsBackToLiveLookups(self):
+        scope_to_check = scope.access_obj(self.obj, "read", "auth.change_permission")
+        live_token_generator = self.getTokenGenerator()
+        live_token = live_token_generator.generate(scope_to_check)
+        live_serialized_scope = live_token_generator._scope_serializer.serialize_scope(scope_to_check)
+        for path in (self.writeSnapshot(b""), os.path.join(self.snapshot_dir, "missing.snapshot")):
+            with self.settings(ACCESS_TOKENS_CODEC_SNAPSHOT=path):
+                self.assertIsNone(snapshot.get_snapshot())
+                token_generator = self.getTokenGenerator()
+                self.assertTrue(token_generator.validate(live_token, scope_to_check))
+                self.assertEqual(token_generator._scope_serializer.serialize_scope(scope_to_check), live_serialized_scope)
+
+    def testReplacedSnapshotIsReloaded(self):
+        path = self.writeSnapshot(b"")
+        with self.settings(ACCESS_TOKENS_CODEC_SNAPSHOT=path):
+            self.assertIsNone(snapshot.get_snapshot())
+            call_command("access_tokens_snapshot", path, verbosity=0)
+            codec_snapshot = snapshot.get_snapshot()
+            self.assertIsNotNone(codec_snapshot)
+            self.assertIs(snapshot.get_snapshot(), codec_snapshot)
@@ -2,21 +2,107 @@
 Token generation and validation.
 """
 
+import hashlib, hmac, numbers, time
+
+from django.conf import settings
 from django.core import signing
+from django.core.exceptions import ImproperlyConfigured, ObjectDoesNotExist
+from django.utils import baseconv
+from django.utils.crypto import constant_time_compare, get_random_string
+from django.utils.encoding import force_bytes, force_str
 
 from access_tokens.scope import _is_sub_scope, default_scope_serializer
+from access_tokens.payload import JSONPayloadSerializer
+from access_tokens.cache import LRUCache
+from access_tokens.keys import derive_tenant_key
 
 
 DEFAULT_SALT = "access_tokens.token"
 
+REFERENCE_LENGTH = 12
+
+NONCE_LENGTH = 16
+
+ATTENUATION_SEPARATOR = "~"
+
+# Errors raised when deserializing or matching a malformed caveat scope.
+CAVEAT_SCOPE_ERRORS = (ObjectDoesNotExist, TypeError, ValueError, KeyError, IndexError,)
+
+
+def _is_well_formed_caveat(caveat):
+    """
+    Returns True if the given caveat is a `(scope, expires)` pair, where the
+    scope is None or a list of grant pairs, and expires is None or a number.
+    """
+    if not isinstance(caveat, (list, tuple)) or len(caveat) != 2:
+        return False
+    caveat_scope, caveat_expires = caveat
+    if caveat_expires is not None and (isinstance(caveat_expires, bool) or not isinstance(caveat_expires, numbers.Real)):
+        return False
+    return caveat_scope is None or isinstance(caveat_scope, (list, tuple)) and all(
+        isinstance(grant, (list, tuple)) and len(grant) == 2
+        for grant
+        in caveat_scope
+    )
+
+
+def _chain_signature(signature, caveat):
+    """
+    Returns the signature of the given caveat, chained from the
+    signature that precedes it.
+    """
+    return force_str(signing.b64_encode(hmac.new(force_bytes(signature), force_bytes(caveat), hashlib.sha256).digest()))
+
 
 class TokenGenerator(object):
 
-    """A token generator."""
+    """
+    A token generator.
+
+    If a `reference_store` is given, the generator issues reference
+    tokens. The serialized scope is saved in the reference store under a
+    short random reference, and only the signed reference is included in
+    the token. Referenced scopes are kept in a local LRU cache of
+    `reference_cache_size` items in front of the store.
+
+    Tokens may be generated and validated for a `tenant`, in which case
+    they are signed with a key derived from the given key, or
+    `settings.SECRET_KEY`, and the tenant. The most recently used
+    `tenant_key_cache_size` derived keys are cached.
 
-    def __init__(self, scope_serializer=default_scope_serializer):
+    If `generation_cache_size` is given, generated tokens are memoized
+    by scope, key, salt and tenant, and reused for the remainder of the
+    `generation_cache_bucket` seconds in which they were issued. A reused
+    token carries its original timestamp, so it expires as if it had
+    been generated when first issued.
+
+    Any holder of a token can derive a narrower token from it using
+    `attenuate`, without knowing the signing key. Each attenuation
+    appends a caveat, and replaces the token's signature with an HMAC
+    chained from it, so caveats cannot be removed again.
+
+    If a `nonce_store` is given, single-use tokens can be generated. A
+    single-use token contains a random nonce, which is recorded in the
+    nonce store when the token is consumed. A consumed token grants
+    nothing.
+
+    If a `usage_recorder` is given, every validation and consumption is
+    recorded with it.
+    """
+
+    def __init__(self, scope_serializer=default_scope_serializer, payload_serializer=JSONPayloadSerializer, reference_store=None, reference_timeout=None, reference_cache_size=1024, tenant_key_cache_size=1024, generation_cache_size=0, generation_cache_bucket=60, nonce_store=None, usage_recorder=None):
         """Initializes the TokenGenerator."""
         self._scope_serializer = scope_serializer
+        self._payload_serializer = payload_serializer
+        self._payload_protocol_version = payload_serializer().get_payload_protocol_version()
+        self._reference_store = reference_store
+        self._reference_timeout = reference_timeout
+        self._reference_cache = LRUCache(reference_cache_size)
+        self._tenant_key_cache = LRUCache(tenant_key_cache_size)
+        self._generation_cache = LRUCache(generation_cache_size) if generation_cache_size else None
+        self._generation_cache_bucket = generation_cache_bucket
+        self._nonce_store = nonce_store
+        self._usage_recorder = usage_recorder
 
     def _get_protocol_version(self):
         """
@@ -30,38 +116,344 @@ class TokenGenerator(object):
     def _get_salt(self, salt=None):
         """
         Returns a composite salt based on the provided salt,
-        the token protocol version, and the scope serializer
-        protocol version.
+        the token protocol version, the scope serializer
+        protocol version and the payload serializer protocol version.
         """
         if salt is None:
             salt = DEFAULT_SALT
-        return ":".join((
+        salt_parts = [
             salt,
             self._get_protocol_version(),
             self._scope_serializer.get_scope_protocol_version(),
-        ))
+        ]
+        if self._payload_protocol_version is not None:
+            salt_parts.append(self._payload_protocol_version)
+        if self._reference_store is not None:
+            salt_parts.append("reference")
+        return ":".join(salt_parts)
+
+    def _get_key(self, key=None, tenant=None):
+        """
+        Returns the signing key for the given key and tenant.
+
+        If a tenant is given, a tenant key is derived from the given key,
+        or `settings.SECRET_KEY`.
+        """
+        if tenant is None:
+            return key
+        master_key = key or settings.SECRET_KEY
+        cache_key = (master_key, tenant)
+        tenant_key = self._tenant_key_cache.get(cache_key)
+        if tenant_key is None:
+            tenant_key = derive_tenant_key(master_key, tenant)
+            self._tenant_key_cache.set(cache_key, tenant_key)
+        return tenant_key
+
+    # Reference token support.
+
+    def _save_reference(self, serialized_scope):
+        """
+        Saves the serialized scope in the reference store, and returns
+        its new reference.
+        """
+        reference = get_random_string(REFERENCE_LENGTH)
+        self._reference_store.set(reference, serialized_scope, self._reference_timeout)
+        self._cache_reference(reference, serialized_scope, time.time())
+        return reference
+
+    def _cache_reference(self, reference, serialized_scope, created):
+        """
+        Caches the serialized scope locally until the reference expires,
+        counting from when the reference was created, not when it was
+        loaded from the store.
+        """
+        if self._reference_timeout is None:
+            expires = None
+        else:
+            expires = created + self._reference_timeout
+        self._reference_cache.set(reference, (expires, serialized_scope))
+
+    def _get_cached_reference(self, reference):
+        cached_reference = self._reference_cache.get(reference)
+        if cached_reference is not None:
+            expires, serialized_scope = cached_reference
+            if expires is None or expires > time.time():
+                return serialized_scope
+            self._reference_cache.delete(reference)
+        return None
+
+    def _unsign_reference(self, signer, token, max_age=None):
+        """
+        Returns the reference in the given reference token, and the time
+        it was created, taken from the token's timestamp.
+
+        Raises BadSignature if the token is invalid or has expired.
+        """
+        reference = signer.unsign(token, max_age=max_age)
+        created = baseconv.base62.decode(token.rsplit(signer.sep, 2)[1])
+        return reference, created
+
+    def _load_reference(self, reference, created):
+        """
+        Returns the serialized scope saved under the given reference,
+        or None if it is unknown or has expired.
+        """
+        serialized_scope = self._get_cached_reference(reference)
+        if serialized_scope is None:
+            serialized_scope = self._reference_store.get(reference)
+            if serialized_scope is not None:
+                self._cache_reference(reference, serialized_scope, created)
+        return serialized_scope
+
+    def prefetch(self, tokens, key=None, salt=None, tenant=None):
+        """
+        Loads the scopes of the given reference tokens from the reference
+        store in a single batch, so that validating them does not
+        consult the store one token at a time.
+
+        Invalid tokens are ignored. If the generator does not issue
+        reference tokens, this does nothing.
+        """
+        if self._reference_store is None:
+            return
+        key = self._get_key(key, tenant)
+        signer = signing.TimestampSigner(key, salt=self._get_salt(salt))
+        references = {}
+        for token in tokens:
+            try:
+                if ATTENUATION_SEPARATOR in token:
+                    token, caveats = self._unpack_attenuated_token(token, key, salt)
+                reference, created = self._unsign_reference(signer, token)
+            except signing.BadSignature:
+                continue
+            if self._get_cached_reference(reference) is None:
+                references[reference] = created
+        if references:
+            for reference, serialized_scope in self._reference_store.get_many(references).items():
+                self._cache_reference(reference, serialized_scope, references[reference])
+
+    # Generation cache support.
+
+    def _get_generation_cache_key(self, scope, key, salt, tenant):
+        """
+        Returns the generation cache key for the given arguments, or None
+        if the scope cannot be used as a cache key.
+
+        Grants, and the permissions within each grant, are unordered, so
+        scopes that differ only in their order share a cache key.
+        """
+        try:
+            cache_key = (
+                int(time.time() // self._generation_cache_bucket),
+                frozenset(
+                    (tuple(model_grant), frozenset(permissions_grant))
+                    for model_grant, permissions_grant
+                    in scope
+                ),
+                key,
+                salt,
+                tenant,
+            )
+            hash(cache_key)
+        except TypeError:
+            return None
+        return cache_key
 
-    def generate(self, scope=(), key=None, salt=None):
+    def generation_cache_info(self):
+        """
+        Returns the generation cache statistics as a CacheInfo tuple, or
+        None if the generation cache is disabled.
+        """
+        if self._generation_cache is None:
+            return None
+        return self._generation_cache.info()
+
+    # Token attenuation support.
+
+    def _split_attenuated_token(self, token):
+        """
+        Returns the signed value, caveats and signature of the given token.
+        """
+        if ATTENUATION_SEPARATOR in token:
+            token_parts = token.split(ATTENUATION_SEPARATOR)
+            return token_parts[0], token_parts[1:-1], token_parts[-1]
+        signer = signing.Signer()
+        if signer.sep not in token:
+            raise signing.BadSignature("No \"%s\" found in token" % signer.sep)
+        value, signature = token.rsplit(signer.sep, 1)
+        return value, [], signature
+
+    def _unpack_attenuated_token(self, token, key, salt):
+        """
+        Verifies the signature chain of the given attenuated token, and
+        returns the original token and the list of caveats.
+
+        Raises BadSignature if the signature chain is invalid.
+        """
+        value, caveats, signature = self._split_attenuated_token(token)
+        root_signature = signing.TimestampSigner(key, salt=self._get_salt(salt)).signature(value)
+        expected_signature = root_signature
+        for caveat in caveats:
+            expected_signature = _chain_signature(expected_signature, caveat)
+        if not constant_time_compare(signature, expected_signature):
+            raise signing.BadSignature("Attenuated token signature does not match")
+        # Holders can chain any caveat, so malformed caveats are possible.
+        try:
+            caveats = [
+                self._payload_serializer().loads(signing.b64_decode(force_bytes(caveat)))
+                for caveat
+                in caveats
+            ]
+        except (TypeError, ValueError):
+            caveats = None
+        if caveats is None or not all(_is_well_formed_caveat(caveat) for caveat in caveats):
+            raise signing.BadSignature("Attenuated token caveat is malformed")
+        return signing.Signer().sep.join((value, root_signature)), [tuple(caveat) for caveat in caveats]
+
+    def _is_caveat_sub_scope(self, scope, caveat_scope):
+        """
+        Returns True if the given scope is granted by the caveat scope.
+
+        Caveat scopes that cannot be deserialized grant nothing.
+        """
+        try:
+            return _is_sub_scope(scope, self._scope_serializer.iter_deserialize_scope(caveat_scope))
+        except CAVEAT_SCOPE_ERRORS:
+            return False
+
+    def attenuate(self, token, scope=None, max_age=None):
+        """
+        Returns a token derived from the given token, that grants no more
+        than the given scope, and expires within `max_age` seconds.
+
+        This does not require the signing key, so can be used by any holder
+        of a token. If the given token is invalid, so is the returned token.
+        """
+        value, caveats, signature = self._split_attenuated_token(token)
+        caveat = force_str(signing.b64_encode(self._payload_serializer().dumps([
+            # Caveat scopes are always serialized as plain grants, never as registered templates.
+            None if scope is None else self._scope_serializer.serialize_scope(tuple(scope)),
+            None if max_age is None else time.time() + max_age,
+        ])))
+        return ATTENUATION_SEPARATOR.join([value] + caveats + [caveat, _chain_signature(signature, caveat)])
+
+    # Token generation and validation.
+
+    def _dumps(self, serialized_scope, key, salt):
+        """
+        Returns a signed token containing the serialized scope.
+        """
+        salt = self._get_salt(salt)
+        if self._reference_store is None:
+            return signing.dumps(serialized_scope, key=key, salt=salt, serializer=self._payload_serializer)
+        return signing.TimestampSigner(key, salt=salt).sign(self._save_reference(serialized_scope))
+
+    def _loads(self, token, key, salt, max_age):
+        """
+        Returns the serialized scope contained in the signed token.
+
+        Raises BadSignature if the token is invalid or has expired.
+        """
+        salt = self._get_salt(salt)
+        if self._reference_store is None:
+            return signing.loads(token, key=key, salt=salt, serializer=self._payload_serializer, max_age=max_age)
+        reference, created = self._unsign_reference(signing.TimestampSigner(key, salt=salt), token, max_age)
+        serialized_scope = self._load_reference(reference, created)
+        if serialized_scope is None:
+            raise signing.BadSignature("Reference %s is unknown or has expired" % reference)
+        return serialized_scope
+
+    def generate(self, scope=(), key=None, salt=None, tenant=None, single_use=False):
         """
         Generates an access token for the given scope.
+
+        If `single_use` is True, the token can be consumed only once.
         """
+        if single_use and self._nonce_store is None:
+            raise ImproperlyConfigured("Single-use tokens require a TokenGenerator with a nonce_store")
+        cache_key = None
+        if self._generation_cache is not None and not single_use:
+            cache_key = self._get_generation_cache_key(scope, key, salt, tenant)
+            if cache_key is not None:
+                token = self._generation_cache.get(cache_key)
+                if token is not None:
+                    return token
         serialized_scope = self._scope_serializer.serialize_scope(scope)
-        return signing.dumps(serialized_scope, key=key, salt=self._get_salt(salt))
+        if single_use:
+            serialized_scope = {"n": get_random_string(NONCE_LENGTH), "s": serialized_scope}
+        token = self._dumps(serialized_scope, self._get_key(key, tenant), salt)
+        if cache_key is not None:
+            self._generation_cache.set(cache_key, token)
+        return token
 
-    def validate(self, token, scope=(), key=None, salt=None, max_age=None):
+    def _validate(self, token, scope, key, salt, max_age, tenant):
         """
         Validates that the given token provides the grants requested by the given
-        scope.
+        scope, without checking whether it has been consumed.
+
+        Returns a tuple of whether the scope is granted, and the token's nonce,
+        or None if the token is not single-use.
         """
+        key = self._get_key(key, tenant)
+        # Verify the caveats of attenuated tokens.
+        caveats = ()
+        if ATTENUATION_SEPARATOR in token:
+            try:
+                token, caveats = self._unpack_attenuated_token(token, key, salt)
+            except signing.BadSignature:
+                return False, None
+            now = time.time()
+            for caveat_scope, caveat_expires in caveats:
+                if caveat_expires is not None and caveat_expires < now:
+                    return False, None
         # Load the token scope.
         try:
-            serialized_token_scope = signing.loads(token, key=key, salt=self._get_salt(salt), max_age=max_age)
+            serialized_token_scope = self._loads(token, key, salt, max_age)
         except signing.BadSignature:
-            return False
-        # Deserialize the scope.
-        token_scope = self._scope_serializer.deserialize_scope(serialized_token_scope)
-        # Check the scopes.
-        return _is_sub_scope(scope, token_scope)
+            return False, None
+        # Unwrap the scope of single-use tokens.
+        nonce = None
+        if isinstance(serialized_token_scope, dict):
+            nonce = serialized_token_scope["n"]
+            serialized_token_scope = serialized_token_scope["s"]
+        # Lazily deserialize the scope, so that grants not needed to check the scope are skipped.
+        token_scope = self._scope_serializer.iter_deserialize_scope(serialized_token_scope)
+        # Check the scopes, including any caveat scopes.
+        return _is_sub_scope(scope, token_scope) and all(
+            self._is_caveat_sub_scope(scope, caveat_scope)
+            for caveat_scope, caveat_expires
+            in caveats
+            if caveat_scope is not None
+        ), nonce
+
+    def validate(self, token, scope=(), key=None, salt=None, max_age=None, tenant=None):
+        """
+        Validates that the given token provides the grants requested by the given
+        scope.
+
+        A single-use token is valid until it has been consumed.
+        """
+        granted, nonce = self._validate(token, scope, key, salt, max_age, tenant)
+        if granted and nonce is not None:
+            granted = self._nonce_store is not None and not self._nonce_store.is_consumed(nonce)
+        if self._usage_recorder is not None:
+            self._usage_recorder.record(token, scope, granted)
+        return granted
+
+    def consume(self, token, scope=(), key=None, salt=None, max_age=None, tenant=None):
+        """
+        Validates that the given single-use token provides the grants requested
+        by the given scope, and consumes it.
+
+        Returns True only the first time a valid token is consumed. Tokens that
+        are not single-use cannot be consumed, so grant nothing. The token is
+        remembered as consumed for `max_age` seconds, or forever if max_age is None.
+        """
+        granted, nonce = self._validate(token, scope, key, salt, max_age, tenant)
+        granted = granted and nonce is not None and self._nonce_store is not None and self._nonce_store.consume(nonce, max_age)
+        if self._usage_recorder is not None:
+            self._usage_recorder.record(token, scope, granted)
+        return granted
 
 
 # Instantiate a default token generator.
@@ -74,4 +466,5 @@ default_token_generator = TokenGenerator()
 
 
 generate = default_token_generator.generate
-validate = default_token_generator.validate
\ No newline at end of file
+validate = default_token_generator.validate
+attenuate = default_token_generator.attenuate
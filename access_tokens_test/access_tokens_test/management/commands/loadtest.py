@@ -0,0 +1,172 @@
+"""
+Drives concurrent token generation and validation traffic through the
+token-protected views, and reports latency, throughput and errors.
+
+The views use the shared default token generator and scope serializer,
+so running this with many threads checks that they are thread-safe.
+"""
+
+import random, tempfile, threading, time, os
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.core.urlresolvers import reverse
+from django.db import connection
+from django.test.client import Client
+
+
+def _percentile(latencies, percentile):
+    """Returns the given percentile of the sorted latencies."""
+    if not latencies:
+        return 0.0
+    return latencies[int(round(percentile * (len(latencies) - 1)))]
+
+
+class LoadTestWorker(threading.Thread):
+
+    """A thread that issues a mix of generate and validate requests."""
+
+    def __init__(self, seed, options):
+        super(LoadTestWorker, self).__init__()
+        self.daemon = True
+        self.random = random.Random(seed)
+        self.options = options
+        self.latencies = {"generate": [], "validate": []}
+        self.errors = {"generate": 0, "validate": 0}
+
+    def _get_request(self, issued_tokens):
+        """
+        Returns the request kind, URL, query and expected status code
+        for the next request.
+        """
+        extra_grants = self.options["extra_grants"]
+        if issued_tokens and self.random.random() < self.options["validate_ratio"]:
+            token, pk = self.random.choice(issued_tokens)
+            if self.random.random() < self.options["deny_ratio"]:
+                # Ask for an object the token does not grant.
+                return "validate", reverse("validate_token"), {
+                    "token": token,
+                    "pk": pk + extra_grants + 1,
+                    "permissions": self.options["permissions"],
+                }, 403
+            return "validate", reverse("validate_token"), {
+                "token": token,
+                "pk": pk,
+                "permissions": self.options["permissions"],
+                "extra_grants": extra_grants,
+            }, 200
+        return "generate", reverse("generate_token"), {
+            "pk": self.random.randint(1, 100000),
+            "permissions": self.options["permissions"],
+            "extra_grants": extra_grants,
+        }, 200
+
+    def run(self):
+        client = Client()
+        issued_tokens = []
+        try:
+            for _ in range(self.options["requests"]):
+                kind, url, query, expected_status_code = self._get_request(issued_tokens)
+                start = time.time()
+                try:
+                    response = client.get(url, query)
+                except Exception:
+                    response = None
+                self.latencies[kind].append(time.time() - start)
+                if response is None or response.status_code != expected_status_code:
+                    self.errors[kind] += 1
+                elif kind == "generate":
+                    issued_tokens.append((response.content.decode("ascii"), query["pk"]))
+        finally:
+            connection.close()
+
+
+class Command(BaseCommand):
+
+    help = "Runs a concurrent load test against the token-protected views."
+
+    option_list = BaseCommand.option_list + (
+        make_option("--threads",
+            type = "int",
+            default = 16,
+            help = "Number of concurrent client threads. Defaults to 16.",
+        ),
+        make_option("--requests",
+            type = "int",
+            default = 200,
+            help = "Number of requests issued by each thread. Defaults to 200.",
+        ),
+        make_option("--validate-ratio",
+            type = "float",
+            default = 0.8,
+            dest = "validate_ratio",
+            help = "Proportion of requests that validate a token. Defaults to 0.8.",
+        ),
+        make_option("--deny-ratio",
+            type = "float",
+            default = 0.1,
+            dest = "deny_ratio",
+            help = "Proportion of validate requests that should be denied. Defaults to 0.1.",
+        ),
+        make_option("--extra-grants",
+            type = "int",
+            default = 0,
+            dest = "extra_grants",
+            help = "Number of additional object grants in each token. Defaults to 0.",
+        ),
+        make_option("--permissions",
+            default = "read,auth.change_permission",
+            help = "Comma-separated permissions granted by each token.",
+        ),
+    )
+
+    def handle(self, **options):
+        # Threads need a shared database, so use a file-backed test database.
+        database_file = tempfile.NamedTemporaryFile(suffix=".db", delete=False)
+        database_file.close()
+        settings.DATABASES["default"]["TEST_NAME"] = database_file.name
+        old_database_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            workers = [
+                LoadTestWorker(seed, options)
+                for seed
+                in range(options["threads"])
+            ]
+            start = time.time()
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+            duration = time.time() - start
+        finally:
+            connection.creation.destroy_test_db(old_database_name, verbosity=0)
+            if os.path.exists(database_file.name):
+                os.remove(database_file.name)
+        # Report the results.
+        total_requests = 0
+        total_errors = 0
+        for kind in ("generate", "validate"):
+            latencies = sorted(
+                latency
+                for worker in workers
+                for latency in worker.latencies[kind]
+            )
+            errors = sum(worker.errors[kind] for worker in workers)
+            total_requests += len(latencies)
+            total_errors += errors
+            self.stdout.write("{kind}: {requests} requests, {errors} errors, p50 {p50:.2f}ms, p99 {p99:.2f}ms".format(
+                kind = kind,
+                requests = len(latencies),
+                errors = errors,
+                p50 = _percentile(latencies, 0.5) * 1000,
+                p99 = _percentile(latencies, 0.99) * 1000,
+            ))
+        self.stdout.write("total: {requests} requests in {duration:.2f}s, {throughput:.1f} requests/s, {errors} errors".format(
+            requests = total_requests,
+            duration = duration,
+            throughput = total_requests / duration,
+            errors = total_errors,
+        ))
+        if total_errors:
+            raise CommandError("{errors} requests failed".format(errors=total_errors))
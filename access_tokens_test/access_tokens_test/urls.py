@@ -9,6 +9,9 @@ urlpatterns = patterns('',
     # url(r'^$', 'access-tokens_test.views.home', name='home'),
     # url(r'^access-tokens_test/', include('access-tokens_test.foo.urls')),
 
+    url(r'^tokens/generate/$', 'access_tokens_test.views.generate_token', name='generate_token'),
+    url(r'^tokens/validate/$', 'access_tokens_test.views.validate_token', name='validate_token'),
+
     # Uncomment the admin/doc line below to enable admin documentation:
     # url(r'^admin/doc/', include('django.contrib.admindocs.urls')),
 
@@ -0,0 +1,41 @@
+"""
+Token-protected views used by the load test harness.
+"""
+
+from django.contrib.auth.models import Permission
+from django.http import HttpResponse, HttpResponseForbidden
+
+from access_tokens import scope, tokens
+
+
+def _get_scope(request):
+    """
+    Returns the scope described by the request's query string.
+
+    The scope grants the comma-separated `permissions` on the Permission
+    object with the given `pk`, plus `extra_grants` additional object
+    grants, to exercise larger scopes.
+    """
+    pk = int(request.GET["pk"])
+    permissions = request.GET.get("permissions", "read").split(",")
+    extra_grants = int(request.GET.get("extra_grants", 0))
+    return sum(
+        (
+            scope.access_obj(Permission(pk=extra_pk), *permissions)
+            for extra_pk
+            in range(pk + 1, pk + 1 + extra_grants)
+        ),
+        scope.access_obj(Permission(pk=pk), *permissions),
+    )
+
+
+def generate_token(request):
+    """Returns an access token for the requested scope."""
+    return HttpResponse(tokens.generate(_get_scope(request)), content_type="text/plain")
+
+
+def validate_token(request):
+    """Returns 200 if the token grants the requested scope, or 403 otherwise."""
+    if tokens.validate(request.GET["token"], _get_scope(request)):
+        return HttpResponse("ok", content_type="text/plain")
+    return HttpResponseForbidden("denied", content_type="text/plain")
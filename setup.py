@@ -16,6 +16,8 @@ setup(
     url = "http://github.com/mohawkhq/django-access-tokens",
     packages = [
         "access_tokens",
+        "access_tokens.management",
+        "access_tokens.management.commands",
     ],
     classifiers = [
         "Development Status :: 5 - Production/Stable",